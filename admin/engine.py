@@ -0,0 +1,310 @@
+# IMPORTS
+import multiprocessing
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timedelta
+import numpy as np
+from flask import current_app
+from sqlalchemy import func, or_
+from sqlalchemy.exc import IntegrityError
+from database import db
+from models import (User, Draw, LotteryRun, RoundResult, Winner, decrypt, decrypt_batch, draw_index, draw_keys,
+                    normalise_draw)
+from admin.scoring import NUMBERS_PER_DRAW, count_matches, draw_mask, encode_draws
+
+# CONFIG
+# number of draw ids bound into a single UPDATE ... WHERE id IN (...) statement
+UPDATE_BATCH_SIZE = 500
+# decryption worker processes are started by a fresh server process instead of forked from this one. a fork of a
+# process with request, KDF and log listener threads can copy a lock held by one of them and hang on it.
+# the server process only imports the models, so the app's after-fork handlers do not run in the workers either
+mp_context = multiprocessing.get_context('forkserver')
+mp_context.set_forkserver_preload(['models'])
+
+
+# raised when another worker process is playing the round, or has taken over the run
+class RunInProgress(Exception):
+    pass
+
+
+# counts the work done against the database during a lottery run
+class RunStats:
+    def __init__(self):
+        self.queries = 0
+        self.rows_read = 0
+        self.rows_updated = 0
+
+    def __repr__(self):
+        return '<RunStats queries=%d rows_read=%d rows_updated=%d>' % (self.queries, self.rows_read,
+                                                                       self.rows_updated)
+
+
+# decrypts draws in batches grouped by owner key, either in the calling thread or over a worker pool
+class Decryptor:
+    def __init__(self, workers=1, executor='process', batch_size=250):
+        self.batch_size = batch_size
+        self.pool = None
+        if workers > 1 and executor == 'process':
+            self.pool = ProcessPoolExecutor(max_workers=workers, mp_context=mp_context)
+        elif workers > 1:
+            self.pool = ThreadPoolExecutor(max_workers=workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if self.pool:
+            self.pool.shutdown()
+
+    # decrypt (draw_key, data) pairs, the decrypted draws are returned in the order given
+    def decrypt(self, pairs):
+        return self.map(decrypt_batch, pairs)
+
+    # apply a module level batch function such as decrypt_batch to (draw_key, data) pairs, the outputs are
+    # returned in the order given
+    def map(self, func, pairs):
+        # sort positions by owner key so each batch reuses as few ciphers as possible
+        order = sorted(range(len(pairs)), key=lambda i: pairs[i][0])
+        batches = [order[i:i + self.batch_size] for i in range(0, len(order), self.batch_size)]
+        work = [[pairs[i] for i in batch] for batch in batches]
+
+        if self.pool:
+            outputs = self.pool.map(func, work)
+        else:
+            outputs = map(func, work)
+
+        # put every output back in its original position
+        results = [None] * len(pairs)
+        for batch, output in zip(batches, outputs):
+            for i, result in zip(batch, output):
+                results[i] = result
+        return results
+
+
+# build a decryptor for a round with the given number of user draws, small rounds are decrypted serially
+def decryptor_for(entries):
+    config = current_app.config
+    if entries < config['DECRYPT_SERIAL_THRESHOLD']:
+        return Decryptor(batch_size=config['DECRYPT_BATCH_SIZE'])
+    return Decryptor(workers=config['DECRYPT_WORKERS'], executor=config['DECRYPT_EXECUTOR'],
+                     batch_size=config['DECRYPT_BATCH_SIZE'])
+
+
+# un-played user draws joined to their owner's keys
+def user_draws_query():
+    return db.session.query(Draw.id, Draw.user_id, Draw.draw, User.draw_key, User.old_draw_key) \
+        .join(User, Draw.user_id == User.id) \
+        .filter(Draw.win == False, Draw.played == False)
+
+
+# start a new run of the winning draw's round for owner, bounded by the highest un-played draw id so draws entered
+# during the run are left for the next round. running a round again with a new winning draw replaces
+# its previous run and history. returns None if no user draws have been entered
+def start_run(stats, winning_draw, owner):
+    entries, last_id = db.session.query(func.count(Draw.id), func.max(Draw.id)) \
+        .filter(Draw.win == False, Draw.played == False) \
+        .one()
+    stats.queries += 1
+    if entries == 0:
+        db.session.commit()
+        return None
+
+    round = winning_draw.round
+    # the previous run is also removed from the session
+    for model in (LotteryRun, Winner, RoundResult):
+        model.query.filter_by(round=round).delete()
+        stats.queries += 1
+
+    now = datetime.now()
+    run = LotteryRun(round=round, winning_draw_id=winning_draw.id, last_id=last_id, last_draw_id=0,
+                     entries=entries, processed=0, winners=0, started_on=now, owner=owner, heartbeat_on=now)
+    db.session.add(run)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # another worker started the round first
+        db.session.rollback()
+        raise RunInProgress('Lottery run for round %d was started by another worker.' % round)
+    stats.queries += 1
+    return run
+
+
+# claim the winning draw's run for owner, so one worker process plays a round at a time. the round's unfinished
+# run of this winning draw is resumed unless another worker has committed a batch of it in the last
+# LOTTERY_RUN_TIMEOUT seconds, otherwise a new run is started. the conditional update is the transaction's
+# first statement, so it takes the write lock and two workers cannot both claim the round.
+# raises RunInProgress if another worker holds the run, returns None if no user draws have been entered
+def claim_run(stats, winning_draw, owner):
+    now = datetime.now()
+    stale = now - timedelta(seconds=current_app.config['LOTTERY_RUN_TIMEOUT'])
+    claimed = LotteryRun.query \
+        .filter(LotteryRun.round == winning_draw.round, LotteryRun.winning_draw_id == winning_draw.id,
+                LotteryRun.finished_on == None, or_(LotteryRun.owner == None, LotteryRun.heartbeat_on < stale)) \
+        .update({LotteryRun.owner: owner, LotteryRun.heartbeat_on: now}, synchronize_session=False)
+    run = LotteryRun.query.filter_by(round=winning_draw.round).populate_existing().first()
+    stats.queries += 2
+
+    if claimed:
+        db.session.commit()
+        stats.queries += 1
+        return run
+    if run is not None and run.winning_draw_id == winning_draw.id:
+        db.session.rollback()
+        if run.finished_on is None:
+            raise RunInProgress('Lottery run for round %d is being played by another worker.' % run.round)
+        raise RunInProgress('Lottery round %d has already been played by another worker.' % run.round)
+    return start_run(stats, winning_draw, owner)
+
+
+# renew the claim on the run with a conditional update of its heartbeat. it is the first write of a transaction,
+# so the run cannot be taken over until the transaction is committed. raises RunInProgress if it was taken over
+def renew_claim(stats, run, owner):
+    owned = LotteryRun.query.filter_by(id=run.id, owner=owner) \
+        .update({LotteryRun.heartbeat_on: datetime.now()}, synchronize_session=False)
+    stats.queries += 1
+    if not owned:
+        db.session.rollback()
+        raise RunInProgress('Lottery run for round %d was taken over by another worker.' % run.round)
+
+
+# give up the claim on a run that failed, so it can be resumed straight away
+def release_claim(run_id, owner):
+    LotteryRun.query.filter_by(id=run_id, owner=owner).update({LotteryRun.owner: None}, synchronize_session=False)
+    db.session.commit()
+
+
+# id of the last draw in the run's next batch of chunk_size un-played draws
+def next_batch_end(stats, run, chunk_size):
+    batch_end = db.session.query(Draw.id) \
+        .filter(Draw.win == False, Draw.played == False, Draw.id > run.last_draw_id, Draw.id <= run.last_id) \
+        .order_by(Draw.id) \
+        .offset(chunk_size - 1) \
+        .limit(1) \
+        .scalar()
+    stats.queries += 1
+    return batch_end or run.last_id
+
+
+# play the winning numbers against the un-played draws after the run's checkpoint up to batch_end, and commit
+# the batch's draw updates and winners together with the new checkpoint, if owner still holds the run
+def play_batch(stats, run, owner, decryptor, winning_numbers, batch_end):
+    tiers = current_app.config['PRIZE_TIERS']
+    in_batch = (Draw.win == False, Draw.played == False, Draw.id > run.last_draw_id, Draw.id <= batch_end)
+
+    if min(tiers) == NUMBERS_PER_DRAW:
+        # jackpot winners are found with one indexed equality query on the blind index, only draws entered
+        # before the blind index was introduced are decrypted
+        matches = [(row, NUMBERS_PER_DRAW) for row in db.session.query(Draw.id, Draw.user_id)
+                   .filter(Draw.draw_index == draw_index(winning_numbers), *in_batch)]
+        stats.queries += 1
+        stats.rows_read += len(matches)
+        candidates = user_draws_query().filter(Draw.draw_index == None, *in_batch).all()
+    else:
+        # partial matches can only be scored on the decrypted numbers, every draw is decrypted
+        matches = []
+        candidates = user_draws_query().filter(*in_batch).all()
+    stats.queries += 1
+    stats.rows_read += len(candidates)
+
+    # matched numbers of every candidate are counted in bulk on their bitmasks
+    decrypted = decryptor.decrypt([(draw_keys(row.draw_key, row.old_draw_key), row.draw) for row in candidates])
+    counts = count_matches(encode_draws(decrypted), draw_mask(winning_numbers))
+    matches.extend((candidates[i], int(counts[i])) for i in np.flatnonzero(np.isin(counts, tiers)))
+
+    renew_claim(stats, run, owner)
+
+    # mark matching draws (used to highlight winning draws in the user's lottery page)
+    matched_ids = sorted(row.id for row, count in matches)
+    for i in range(0, len(matched_ids), UPDATE_BATCH_SIZE):
+        stats.rows_updated += Draw.query.filter(Draw.id.in_(matched_ids[i:i + UPDATE_BATCH_SIZE])) \
+            .update({Draw.match: True}, synchronize_session=False)
+        stats.queries += 1
+
+    # mark every user draw in the batch as played
+    played = Draw.query.filter(*in_batch) \
+        .update({Draw.played: True, Draw.round: run.round}, synchronize_session=False)
+    stats.rows_updated += played
+    stats.queries += 1
+
+    # winners are kept for the history views
+    if matches:
+        db.session.execute(Winner.__table__.insert(),
+                           [{'round': run.round, 'user_id': row.user_id, 'draw_id': row.id, 'matches': count}
+                            for row, count in matches])
+        stats.queries += 1
+
+    run.last_draw_id = batch_end
+    run.processed += played
+    run.winners += len(matches)
+    db.session.commit()
+    stats.queries += 1
+
+
+# play the given winning draw against every un-played user draw, one checkpointed batch of chunk_size draws
+# per transaction. an interrupted run is resumed from its checkpoint when the round is run again, without
+# reading the finished batches again. the winning draw is only marked as played once every batch is done.
+# the run is claimed in the database first, so the round is played by one worker process at a time.
+# returns (results, stats), results is None if no user draws have been entered for the round. raises
+# RunInProgress if another worker is playing the round. progress is called with (processed, total) user draws
+# after every batch
+def run_round(winning_draw, winning_key, chunk_size=None, progress=None):
+    chunk_size = chunk_size or current_app.config['LOTTERY_CHUNK_SIZE']
+    progress = progress or (lambda processed, total: None)
+    stats = RunStats()
+    winning_numbers = normalise_draw(decrypt(winning_draw.draw, winning_key))
+    if winning_numbers is None:
+        raise ValueError('winning draw of round %d is malformed' % winning_draw.round)
+
+    # resume the round's unfinished run of this winning draw, or start a new one
+    owner = uuid.uuid4().hex
+    run = claim_run(stats, winning_draw, owner)
+    if run is None:
+        return None, stats
+    run_id = run.id
+
+    try:
+        progress(run.processed, run.entries)
+        with decryptor_for(run.entries - run.processed) as decryptor:
+            while run.last_draw_id < run.last_id:
+                play_batch(stats, run, owner, decryptor, winning_numbers, next_batch_end(stats, run, chunk_size))
+                progress(run.processed, run.entries)
+
+        # the round's result is kept for the history views, marking the winning draw as played ends the round
+        renew_claim(stats, run, owner)
+        finished_on = datetime.now()
+        db.session.add(RoundResult(round=run.round, winning_draw=winning_numbers, entries=run.entries,
+                                   winners=run.winners, started_on=run.started_on, finished_on=finished_on,
+                                   seconds=(finished_on - run.started_on).total_seconds()))
+        stats.rows_updated += Draw.query.filter_by(id=winning_draw.id) \
+            .update({Draw.played: True}, synchronize_session=False)
+        run.finished_on = finished_on
+        db.session.commit()
+        stats.queries += 2
+    except Exception:
+        db.session.rollback()
+        release_claim(run_id, owner)
+        raise
+
+    return winner_results(stats, run.round), stats
+
+
+# details of a played round's winners by prize tier, including those found before an interruption, as
+# (round, user id, email, id of the winning user draw, numbers matched)
+def winner_results(stats, round):
+    winners = db.session.query(Winner.user_id, User.email, Winner.draw_id, Winner.matches) \
+        .join(User, Winner.user_id == User.id) \
+        .filter(Winner.round == round) \
+        .order_by(Winner.matches.desc(), Winner.draw_id) \
+        .all()
+    stats.queries += 1
+    return [(round, user_id, email, draw_id, matches) for user_id, email, draw_id, matches in winners]
+
+
+# number of a played round's winners in each prize tier, as {numbers matched: winners}
+def tier_counts(stats, round):
+    counts = db.session.query(Winner.matches, func.count(Winner.id)) \
+        .filter(Winner.round == round) \
+        .group_by(Winner.matches) \
+        .all()
+    stats.queries += 1
+    return dict(counts)
@@ -0,0 +1,150 @@
+# IMPORTS
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from flask import current_app
+from models import User, Draw, LotteryRun, draw_keys
+from admin.engine import RunInProgress, RunStats, run_round, tier_counts
+
+# CONFIG
+# number of finished jobs of this process kept for status polling
+JOB_HISTORY_SIZE = 100
+# job statuses that say nothing about the round's run, its status is read from the database instead
+REMOTE_STATUSES = ('running_elsewhere', 'expired')
+
+# lottery runs are processed one at a time by a single in-process worker
+executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='lottery-run')
+
+# jobs submitted to this process by lottery round, a local cache of the runs in the lottery_runs table
+jobs = OrderedDict()
+# jobs that have not finished, by lottery round
+running = {}
+lock = threading.Lock()
+
+
+# the worker thread does not survive a fork, a forked process starts with its own worker and no jobs
+def reset_jobs():
+    global executor, lock
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='lottery-run')
+    jobs.clear()
+    running.clear()
+    lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=reset_jobs)
+
+
+# a lottery run submitted to the worker, polled by the admin for progress and results
+class LotteryJob:
+    def __init__(self, round):
+        self.round = round
+        self.status = 'queued'
+        self.processed = 0
+        self.total = 0
+        # number of winners in each prize tier once the run has finished, the winners are paged by round_winners
+        self.winners = None
+        self.stats = None
+        self.error = None
+
+    def progress(self, processed, total):
+        self.processed = processed
+        self.total = total
+
+    def to_dict(self):
+        return {'round': self.round,
+                'status': self.status,
+                'processed': self.processed,
+                'total': self.total,
+                'winners': self.winners,
+                'queries': self.stats.queries if self.stats else None,
+                'rows_read': self.stats.rows_read if self.stats else None,
+                'rows_updated': self.stats.rows_updated if self.stats else None,
+                'error': self.error}
+
+
+# submit a lottery run for a round, returns (job, submitted).
+# a round that is already queued or running is not submitted again and its existing job is returned
+def submit_lottery_run(round):
+    with lock:
+        if round in running:
+            return running[round], False
+
+        job = LotteryJob(round)
+        running[round] = job
+        jobs[round] = job
+        jobs.move_to_end(round)
+        # forget the oldest finished jobs
+        while len(jobs) > JOB_HISTORY_SIZE:
+            oldest = next(iter(jobs.values()))
+            if running.get(oldest.round) is oldest:
+                break
+            jobs.popitem(last=False)
+
+    executor.submit(run_job, current_app._get_current_object(), job)
+    return job, True
+
+
+# status of a round's lottery run as a job. a run submitted to another worker process, or before this process
+# started, is read from the lottery_runs table. returns None if the round has not been submitted or run
+def get_job(round):
+    with lock:
+        job = jobs.get(round)
+    if job is not None and job.status not in REMOTE_STATUSES:
+        return job
+    return run_status(round) or job
+
+
+# status of a round's lottery run read from the database. an unfinished run whose owner gave it up, or has not
+# committed a batch for LOTTERY_RUN_TIMEOUT seconds, was interrupted. returns None if the round has not been run
+def run_status(round):
+    run = LotteryRun.query.filter_by(round=round).first()
+    if run is None:
+        return None
+
+    job = LotteryJob(round)
+    job.progress(run.processed, run.entries)
+    stale = datetime.now() - timedelta(seconds=current_app.config['LOTTERY_RUN_TIMEOUT'])
+    if run.finished_on is not None:
+        job.status = 'finished'
+        job.winners = tier_counts(RunStats(), round)
+    elif run.owner is None or run.heartbeat_on < stale:
+        job.status = 'interrupted'
+    else:
+        job.status = 'running'
+    return job
+
+
+# run a lottery job in the worker thread
+def run_job(app, job):
+    with app.app_context():
+        job.status = 'running'
+        try:
+            # get the round's un-played winning draw
+            winning_draw = Draw.query.filter_by(win=True, played=False, round=job.round).first()
+
+            if not winning_draw:
+                job.status = 'expired'
+                return
+
+            # the winning draw is decrypted with its owner's current keys
+            owner = User.query.get(winning_draw.user_id)
+            winning_key = draw_keys(owner.draw_key, owner.old_draw_key)
+
+            results, job.stats = run_round(winning_draw, winning_key, progress=job.progress)
+            if results is None:
+                job.status = 'no_entries'
+            else:
+                job.winners = tier_counts(job.stats, job.round)
+                job.status = 'finished'
+        except RunInProgress as e:
+            # a submission that reached another worker process while the round is played there
+            job.status = 'running_elsewhere'
+            job.error = str(e)
+        except Exception as e:
+            job.status = 'failed'
+            job.error = repr(e)
+        finally:
+            with lock:
+                running.pop(job.round, None)
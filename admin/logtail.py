@@ -0,0 +1,92 @@
+# IMPORTS
+import os
+
+# CONFIG
+# bytes read per step when seeking back from the end of a log file
+BLOCK_SIZE = 8192
+
+
+# read complete lines backwards from the end of a file in blocks, stopping once n lines are read.
+# returns (lines oldest first, offset just after the last complete line, inode of the file)
+def read_tail(path, n, block_size=BLOCK_SIZE):
+    with open(path, 'rb') as f:
+        inode = os.fstat(f.fileno()).st_ino
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+
+        data = b''
+        pos = size
+        # n complete lines need n + 1 newlines unless the start of the file is reached
+        while pos > 0 and data.count(b'\n') <= n:
+            step = min(block_size, pos)
+            pos -= step
+            f.seek(pos)
+            data = f.read(step) + data
+
+    # leave a line that is still being written for the next poll
+    end = data.rfind(b'\n') + 1
+    lines = data[:end].decode('utf-8', errors='replace').splitlines()
+    return lines[-n:] if n else [], pos + end, inode
+
+
+# read at most n complete lines forwards from offset since. a file smaller than the offset was truncated and is
+# read from the start. returns (lines oldest first, offset just after the last line returned, inode of the file)
+def read_forward(path, n, since):
+    with open(path, 'rb') as f:
+        stat = os.fstat(f.fileno())
+        if since > stat.st_size:
+            since = 0
+        f.seek(since)
+
+        lines = []
+        offset = since
+        for line in f:
+            # leave a line that is still being written for the next poll
+            if len(lines) == n or not line.endswith(b'\n'):
+                break
+            lines.append(line.decode('utf-8', errors='replace').rstrip('\r\n'))
+            offset += len(line)
+    return lines, offset, stat.st_ino
+
+
+# last n lines of a log, continuing into the rotated file (path.1) when the current file is too short.
+# returns (lines oldest first, offset and inode to follow the log from)
+def tail(path, n, block_size=BLOCK_SIZE):
+    try:
+        lines, offset, inode = read_tail(path, n, block_size)
+    except FileNotFoundError:
+        return [], 0, None
+
+    if len(lines) < n:
+        try:
+            rotated, _, _ = read_tail(path + '.1', n - len(lines), block_size)
+            lines = rotated + lines
+        except FileNotFoundError:
+            pass
+
+    return lines, offset, inode
+
+
+# up to n lines written to a log after the offset and inode returned by the last poll, for follow-style polling.
+# a burst of more than n lines is returned over several polls. if the log was rotated since the last poll the
+# rest of the rotated file (path.1) is returned first, lines in a file rotated more than once between polls
+# are skipped. returns (lines oldest first, offset and inode to poll from next)
+def follow(path, n, since, inode=None):
+    try:
+        current = os.stat(path).st_ino
+    except FileNotFoundError:
+        return [], 0, None
+
+    if inode is not None and inode != current:
+        try:
+            lines, offset, rotated = read_forward(path + '.1', n, since)
+            if rotated == inode and lines:
+                return lines, offset, rotated
+        except FileNotFoundError:
+            pass
+        since = 0
+
+    try:
+        return read_forward(path, n, since)
+    except FileNotFoundError:
+        return [], 0, None
@@ -0,0 +1,58 @@
+# IMPORTS
+import re
+import numpy as np
+
+# CONFIG
+NUMBERS_PER_DRAW = 6
+# numbers are 1-60, so the numbers of a draw fit in the bits of one unsigned 64-bit integer
+MAX_NUMBER = 60
+# text of a list of draws that can be parsed in one go
+DIGITS = re.compile(r'[0-9 ]*')
+
+# constants of the bit-twiddling popcount, for NumPy versions without bitwise_count
+M1 = np.uint64(0x5555555555555555)
+M2 = np.uint64(0x3333333333333333)
+M4 = np.uint64(0x0f0f0f0f0f0f0f0f)
+H01 = np.uint64(0x0101010101010101)
+
+
+# bitmask of a draw's numbers, bit n is set if n is one of the numbers. a malformed draw has no bits set
+def draw_mask(draw):
+    numbers = draw.split()
+    if len(numbers) != NUMBERS_PER_DRAW or not all(n.isdigit() and 1 <= int(n) <= MAX_NUMBER for n in numbers):
+        return 0
+
+    mask = 0
+    for n in numbers:
+        mask |= 1 << int(n)
+    return mask
+
+
+# bitmasks of a list of decrypted draws as a uint64 array.
+# the draws are parsed in one go: every draw is followed by a 0, so the numbers only line up in rows of 7
+# ending in 0 if every draw has 6 numbers. otherwise they are parsed one by one
+def encode_draws(draws):
+    text = ' 0 '.join(draws) + ' 0'
+    if DIGITS.fullmatch(text):
+        numbers = np.fromstring(text, dtype=np.int64, sep=' ')
+        if len(numbers) == (NUMBERS_PER_DRAW + 1) * len(draws):
+            numbers = numbers.reshape(len(draws), NUMBERS_PER_DRAW + 1)
+            values, ends = numbers[:, :-1], numbers[:, -1]
+            if not ends.any() and ((values >= 1) & (values <= MAX_NUMBER)).all():
+                return np.bitwise_or.reduce(np.left_shift(np.uint64(1), values.astype(np.uint64)), axis=1)
+
+    return np.array([draw_mask(draw) for draw in draws], dtype=np.uint64)
+
+
+def popcount(values):
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(values)
+    values = values - ((values >> np.uint64(1)) & M1)
+    values = (values & M2) + ((values >> np.uint64(2)) & M2)
+    values = (values + (values >> np.uint64(4))) & M4
+    return ((values * H01) >> np.uint64(56)).astype(np.uint8)
+
+
+# numbers of the winning draw matched by every draw, for an array of draw bitmasks
+def count_matches(masks, winning_mask):
+    return popcount(masks & np.uint64(winning_mask))
@@ -1,12 +1,23 @@
 # IMPORTS
-import copy
-from flask import Blueprint, render_template, request, flash
+from flask import Blueprint, render_template, request, flash, jsonify, abort, current_app, Response, url_for
 from flask_login import current_user
-from app import db, login_required, requires_roles
-from models import User, Draw
+from app import login_required, requires_roles
+from database import db, read_session
+import kdf
+from limiter import request_limiter
+from metrics import render_prometheus
+from models import (User, Draw, RoundResult, Winner, DrawView, DRAW_VIEW_COLUMNS, cipher_cache, current_draw_key,
+                    parse_form_draw)
+from users.cache import user_cache
+from users.throttle import login_throttle
+from admin.jobs import submit_lottery_run, get_job
+from admin.logtail import follow, tail
+from pagination import keyset_page, page_cursor
 
 # CONFIG
 admin_blueprint = Blueprint('admin', __name__, template_folder='templates')
+# most log entries returned by one poll
+LOG_POLL_LINES = 100
 
 
 # VIEWS
@@ -23,8 +34,9 @@ def admin():
 @login_required
 @requires_roles('admin')
 def view_all_users():
+    page = keyset_page(read_session.query(User).filter_by(role='user'), User.id, after=page_cursor())
     return render_template('admin.html', name=current_user.firstname,
-                           current_users=User.query.filter_by(role='user').all())
+                           current_users=page.items, users_page=page)
 
 
 # create a new winning draw
@@ -32,6 +44,12 @@ def view_all_users():
 @login_required
 @requires_roles('admin')
 def create_winning_draw():
+    # get new winning draw entered in form, the current winning draw is kept if it is rejected
+    submitted_draw, reason = parse_form_draw(request.form)
+    if reason:
+        flash(reason)
+        return admin()
+
     # get current winning draw
     current_winning_draw = Draw.query.filter_by(win=True).first()
     current_round = 1
@@ -45,16 +63,9 @@ def create_winning_draw():
         db.session.delete(current_winning_draw)
         db.session.commit()
 
-    # get new winning draw entered in form
-    submitted_draw = ''
-    for i in range(6):
-        submitted_draw += request.form.get('no' + str(i + 1)) + ' '
-    # remove any surrounding whitespace
-    submitted_draw.strip()
-
     # create a new draw object with the form data.
     new_winning_draw = Draw(user_id=current_user.id, draw=submitted_draw, win=True, round=current_round,
-                            draw_key=current_user.draw_key)
+                            draw_key=current_draw_key(current_user.id))
 
     # add the new winning draw to the database
     db.session.add(new_winning_draw)
@@ -71,17 +82,18 @@ def create_winning_draw():
 @requires_roles('admin')
 def view_winning_draw():
 
-    # get winning draw from DB
-    current_winning_draw = Draw.query.filter_by(win=True).first()
+    # get winning draw columns from DB
+    current_winning_draw = db.session.query(*DRAW_VIEW_COLUMNS) \
+        .join(User, Draw.user_id == User.id) \
+        .filter(Draw.win == True) \
+        .first()
 
     # if a winning draw exists
     if current_winning_draw:
-        # create a copy which is independent of database
-        draw_copy = copy.deepcopy(current_winning_draw)
-        # decrypt copy of draw
-        draw_copy.view_draw(current_user.draw_key)
+        # decrypt into a read-only view of the draw
+        winning_draw = DrawView.decrypt(current_winning_draw)
         # re-render admin page with current winning draw and lottery round
-        return render_template('admin.html', winning_draw=draw_copy, name=current_user.firstname)
+        return render_template('admin.html', winning_draw=winning_draw, name=current_user.firstname)
 
     # if no winning draw exists, rerender admin page
     flash("No winning draw exists. Please add winning draw.")
@@ -99,77 +111,98 @@ def run_lottery():
 
     # if current un-played winning draw exists
     if current_winning_draw:
-        # create a copy which is independent of database
-        draw_copy = copy.deepcopy(current_winning_draw)
-        # decrypt copy of draw
-        draw_copy.view_draw(current_user.draw_key)
-
-        # get all un-played user draws
-        user_draws = Draw.query.filter_by(win=False, played=False).all()
-        # creates a list of copied draw objects which are independent of database.
-        user_draws_copies = list(map(lambda x: copy.deepcopy(x), user_draws))
-        # empty list for decrypted copied draw objects
-        decrypted_user_draws = []
-
-        # decrypt each copied draw object and add it to decrypted_draws array.
-        for d in user_draws_copies:
-            d.view_draw(User.query.filter_by(id=d.user_id).first().draw_key)
-            decrypted_user_draws.append(d)
-
-        results = []
-
-        # if at least one un-played user draw exists
-        if user_draws:
-
-            # update current winning draw as played
-            current_winning_draw.played = True
-            db.session.add(current_winning_draw)
-            db.session.commit()
+        # score all un-played user draws against the winning draw in the background
+        job, submitted = submit_lottery_run(current_winning_draw.round)
 
-            # for each un-played user draw
-            for draw in decrypted_user_draws:
+        if submitted:
+            flash("Lottery run for round %d submitted." % job.round)
+        else:
+            flash("Lottery run for round %d is already running." % job.round)
+        return render_template('admin.html', job=job, name=current_user.firstname)
 
-                # get the owning user (instance/object)
-                user = User.query.filter_by(id=draw.user_id).first()
+    # if current un-played winning draw does not exist
+    flash("Current winning draw expired. Add new winning draw for next round.")
+    return admin()
 
-                # if user draw matches current un-played winning draw
-                if draw.draw == draw_copy.draw:
 
-                    # add details of winner to list of results
-                    results.append((draw_copy.round, draw.draw, draw.user_id, user.email))
+# progress and winners of a lottery run, polled as JSON
+@admin_blueprint.route('/lottery_job/<int:round>')
+@login_required
+@requires_roles('admin')
+def lottery_job(round):
+    job = get_job(round)
+    if not job:
+        abort(404)
+    status = job.to_dict()
+    if job.status == 'finished':
+        # the winners themselves are paged
+        status['winners_url'] = url_for('admin.round_winners', round=job.round)
+    return jsonify(status)
+
+
+# view lottery results and winners of a lottery run
+@admin_blueprint.route('/view_lottery_job', methods=['POST'])
+@login_required
+@requires_roles('admin')
+def view_lottery_job():
+    job = get_job(request.form.get('round', type=int))
 
-                    # update draw as a winning draw (this will be used to highlight winning draws in the user's
-                    # lottery page)
-                    for d in user_draws:
-                        if d.id == draw.id:
-                            d.match = True
-                            # commit draw changes to DB
-                            db.session.add(d)
-                            db.session.commit()
+    if not job:
+        flash("Lottery run not found.")
+        return admin()
 
-            for d in user_draws:
-                # update draw as played
-                d.played = True
+    if job.status == 'finished':
+        # if no winners
+        if not job.winners:
+            flash("No winners.")
+        return render_template('admin.html', job=job, run_stats=job.stats, name=current_user.firstname)
 
-                # update draw with current lottery round
-                d.round = current_winning_draw.round
+    if job.status == 'no_entries':
+        flash("No user draws entered.")
+    elif job.status == 'expired':
+        flash("Current winning draw expired. Add new winning draw for next round.")
+    elif job.status == 'running_elsewhere':
+        flash("Lottery run for round %d is already running in another worker." % job.round)
+    elif job.status == 'failed':
+        flash("Lottery run for round %d failed." % job.round)
+    elif job.status == 'interrupted':
+        flash("Lottery run for round %d was interrupted after %d of %d draws. Run the lottery to resume it."
+              % (job.round, job.processed, job.total))
+    else:
+        flash("Lottery run for round %d: %d of %d draws processed." % (job.round, job.processed, job.total))
+    return render_template('admin.html', job=job, name=current_user.firstname)
+
+
+# results of played rounds, read from the history tables instead of the draws
+@admin_blueprint.route('/round_history', methods=['POST'])
+@login_required
+@requires_roles('admin')
+def round_history():
+    page = keyset_page(read_session.query(RoundResult), RoundResult.id, after=page_cursor())
 
-                # commit draw changes to DB
-                db.session.add(d)
-                db.session.commit()
+    if page.total == 0:
+        flash("No lottery rounds played.")
+        return admin()
+    return render_template('admin.html', rounds=page.items, rounds_page=page, name=current_user.firstname)
 
-            # if no winners
-            if len(results) == 0:
-                flash("No winners.")
 
-            return render_template('admin.html', results=results, name=current_user.firstname)
+# winners of one played round, also linked from a finished lottery run's status
+@admin_blueprint.route('/round_winners', methods=['GET', 'POST'])
+@login_required
+@requires_roles('admin')
+def round_winners():
+    round_result = read_session.query(RoundResult).filter_by(round=request.values.get('round', type=int)).first()
 
-        flash("No user draws entered.")
+    if not round_result:
+        flash("Lottery round not found.")
         return admin()
 
-    # if current un-played winning draw does not exist
-    flash("Current winning draw expired. Add new winning draw for next round.")
-    return admin()
+    winners = read_session.query(Winner.id, Winner.user_id, Winner.draw_id, Winner.matches, User.email) \
+        .join(User, Winner.user_id == User.id) \
+        .filter(Winner.round == round_result.round)
+    page = keyset_page(winners, Winner.id, after=page_cursor())
+    return render_template('admin.html', round_result=round_result, round_winners=page.items, winners_page=page,
+                           name=current_user.firstname)
 
 
 # view last 10 log entries
@@ -177,8 +210,37 @@ def run_lottery():
 @login_required
 @requires_roles('admin')
 def logs():
-    with open("lottery.log", "r") as f:
-        content = f.read().splitlines()[-10:]
-        content.reverse()
+    # read only the end of the log
+    content, offset, inode = tail(current_app.config['LOG_FILE'], 10)
+    content.reverse()
 
     return render_template('admin.html', logs=content, name=current_user.firstname)
+
+
+# log entries polled as JSON: the last entries, then with the offset and inode of the previous poll, up to
+# LOG_POLL_LINES entries written since
+@admin_blueprint.route('/logs/tail')
+@login_required
+@requires_roles('admin')
+def logs_tail():
+    since = request.args.get('since', type=int)
+    if since is None:
+        content, offset, inode = tail(current_app.config['LOG_FILE'], LOG_POLL_LINES)
+    else:
+        content, offset, inode = follow(current_app.config['LOG_FILE'], LOG_POLL_LINES, since,
+                                        inode=request.args.get('inode', type=int))
+
+    return jsonify(lines=content, offset=offset, inode=inode)
+
+
+# request, SQL, crypto and template timings in Prometheus text format
+@admin_blueprint.route('/metrics')
+@login_required
+@requires_roles('admin')
+def metrics():
+    gauges = {'cipher_cache': cipher_cache.stats(),
+              'user_cache': user_cache.stats(),
+              'login_throttle': login_throttle.stats(),
+              'limiter': request_limiter.stats(),
+              'kdf': {'rejected': kdf.pool.rejected if kdf.pool else 0}}
+    return Response(render_prometheus(gauges), mimetype='text/plain; version=0.0.4')
@@ -1,12 +1,21 @@
 # IMPORTS
+import atexit
 import logging
+import os
+import queue
 import socket
 from functools import wraps
+from logging.handlers import (QueueHandler, QueueListener, RotatingFileHandler, TimedRotatingFileHandler,
+                              WatchedFileHandler)
 from flask_login.config import EXEMPT_METHODS
 from flask import Flask, render_template, current_app, request
-from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, current_user
 from flask_talisman import Talisman
+from commands import init_commands
+from database import dispose_engines, init_database
+from limiter import init_limiter
+from metrics import init_metrics
+from querycount import init_query_checks
 
 
 # LOGGING
@@ -16,29 +25,215 @@ class SecurityFilter(logging.Filter):
         return "SECURITY" in record.getMessage()
 
 
-fh = logging.FileHandler('lottery.log', 'w')
-# track and log events at WARNING level and above
-fh.setLevel(logging.WARNING)
-fh.addFilter(SecurityFilter())
-formatter = logging.Formatter('%(asctime)s : %(message)s', '%m/%d/%Y %I:%M:%S %p')
-fh.setFormatter(formatter)
+# records are flushed to disk once per batch by the listener instead of once per record
+class BatchFlushMixin:
+    def flush(self):
+        pass
+
+    def flush_batch(self):
+        logging.StreamHandler.flush(self)
 
-logger = logging.getLogger('')
-# logging messages are not passed to the handlers of other loggers
-logger.propagate = False
-logger.addHandler(fh)
+
+class BatchRotatingFileHandler(BatchFlushMixin, RotatingFileHandler):
+    pass
+
+
+class BatchTimedRotatingFileHandler(BatchFlushMixin, TimedRotatingFileHandler):
+    pass
+
+
+# reopens the log file when it has been moved away, e.g. by logrotate
+class BatchWatchedFileHandler(BatchFlushMixin, WatchedFileHandler):
+    pass
+
+
+# writes queued records on its own thread, draining up to batch_size records per disk flush
+class BatchQueueListener(QueueListener):
+    def __init__(self, queue, *handlers, batch_size=100):
+        super().__init__(queue, *handlers, respect_handler_level=True)
+        self.batch_size = batch_size
+
+    def _monitor(self):
+        stopping = False
+        while not stopping:
+            batch = [self.dequeue(True)]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.dequeue(False))
+                except queue.Empty:
+                    break
+
+            for record in batch:
+                if record is self._sentinel:
+                    stopping = True
+                else:
+                    self.handle(record)
+            for handler in self.handlers:
+                handler.flush_batch()
+
+
+# requests only put security records on a queue, a listener thread writes them to the rotating log file
+def setup_logging(config):
+    if config['LOG_ROTATION'] == 'external':
+        fh = BatchWatchedFileHandler(config['LOG_FILE'])
+    elif config['LOG_ROTATION'] == 'time':
+        fh = BatchTimedRotatingFileHandler(config['LOG_FILE'], when=config['LOG_ROTATE_WHEN'],
+                                           backupCount=config['LOG_BACKUP_COUNT'])
+    else:
+        fh = BatchRotatingFileHandler(config['LOG_FILE'], 'a', maxBytes=config['LOG_MAX_BYTES'],
+                                      backupCount=config['LOG_BACKUP_COUNT'])
+    formatter = logging.Formatter('%(asctime)s : %(message)s', '%m/%d/%Y %I:%M:%S %p')
+    fh.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    qh = QueueHandler(log_queue)
+    # track and log events at WARNING level and above
+    qh.setLevel(logging.WARNING)
+    # only security events are queued
+    qh.addFilter(SecurityFilter())
+
+    logger = logging.getLogger('')
+    # logging messages are not passed to the handlers of other loggers
+    logger.propagate = False
+    logger.addHandler(qh)
+
+    listener = BatchQueueListener(log_queue, fh, batch_size=config['LOG_BATCH_SIZE'])
+    listener.start()
+    return listener
+
+
+# settings the security log is set up from
+LOG_SETTINGS = ('LOG_FILE', 'LOG_ROTATION', 'LOG_MAX_BYTES', 'LOG_ROTATE_WHEN', 'LOG_BACKUP_COUNT', 'LOG_BATCH_SIZE')
+
+log_listener = None
+log_settings = None
+
+
+# stop a listener once it has written out the queued records, and detach its queue and file handlers
+def teardown_logging(listener):
+    logger = logging.getLogger('')
+    for handler in list(logger.handlers):
+        if isinstance(handler, QueueHandler) and handler.queue is listener.queue:
+            logger.removeHandler(handler)
+    listener.stop()
+    for handler in listener.handlers:
+        handler.close()
+
+
+# logging is process-wide, every app in the process logs to the same file. an app created with different log
+# settings from the current ones replaces the log, records queued for the old file are written to it first
+def init_logging(config):
+    global log_listener, log_settings
+    settings = tuple(config[name] for name in LOG_SETTINGS)
+    if log_listener is not None and settings != log_settings:
+        teardown_logging(log_listener)
+        log_listener = None
+    if log_listener is None:
+        log_listener = setup_logging(config)
+        log_settings = settings
+
+
+# start a new listener thread for the same queue and log file, e.g. in a forked worker
+def restart_logging():
+    global log_listener
+    if log_listener is not None:
+        log_listener = BatchQueueListener(log_listener.queue, *log_listener.handlers,
+                                          batch_size=log_listener.batch_size)
+        log_listener.start()
+
+
+# write out queued records on shutdown
+@atexit.register
+def stop_logging():
+    if log_listener is not None:
+        log_listener.stop()
 
 
 # CONFIG
-app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///lottery.db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SECRET_KEY'] = 'LongAndRandomSecretKey'
-app.config['RECAPTCHA_PUBLIC_KEY'] = "6LfaLQEdAAAAAN2TYZO3d53-59chlOiQlEnYk6qR"
-app.config['RECAPTCHA_PRIVATE_KEY'] = "6LfaLQEdAAAAAKjqEtMbcXa_XCkkWzUuWCBnF7kg"
+# default configuration, create_app(config) overrides any of these
+class Config:
+    SQLALCHEMY_DATABASE_URI = 'sqlite:///lottery.db'
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # connections per worker process for writes and for read-only views, shared by the worker's threads.
+    # a thread waits at most DB_POOL_TIMEOUT seconds for a free connection
+    DB_POOL_SIZE = 5
+    DB_READ_POOL_SIZE = 10
+    DB_MAX_OVERFLOW = 10
+    DB_POOL_TIMEOUT = 30
+    # set on every SQLite connection: readers do not block on a writer and vice versa, a writer waits up to
+    # busy_timeout milliseconds for another writer instead of failing with 'database is locked'
+    SQLITE_PRAGMAS = {'journal_mode': 'WAL', 'synchronous': 'NORMAL', 'busy_timeout': 10000,
+                      'mmap_size': 256 * 1024 * 1024}
+    SECRET_KEY = 'LongAndRandomSecretKey'
+    RECAPTCHA_PUBLIC_KEY = "6LfaLQEdAAAAAN2TYZO3d53-59chlOiQlEnYk6qR"
+    RECAPTCHA_PRIVATE_KEY = "6LfaLQEdAAAAAKjqEtMbcXa_XCkkWzUuWCBnF7kg"
+    # password hashing and draw key derivation cost, run on a pool of KDF_WORKERS threads.
+    # at most KDF_QUEUE_DEPTH more derivations wait for a worker, the rest are turned away with a 503
+    PASSWORD_HASH_METHOD = 'pbkdf2:sha256:260000'
+    KDF_SCRYPT_N = 2 ** 14
+    KDF_SCRYPT_R = 8
+    KDF_SCRYPT_P = 1
+    KDF_WORKERS = os.cpu_count() or 1
+    KDF_QUEUE_DEPTH = 32
+    # login attempts allowed in a burst and refilled per second, per client IP and per account
+    LOGIN_IP_BURST = 20
+    LOGIN_IP_RATE = 20 / 60
+    LOGIN_ACCOUNT_BURST = 5
+    LOGIN_ACCOUNT_RATE = 5 / 300
+    # requests in flight per worker, overall and for expensive endpoints, before new requests are shed with a 503
+    MAX_IN_FLIGHT = 64
+    ENDPOINT_IN_FLIGHT = {'admin.run_lottery': 2, 'users.register': 8, 'users.login': 16}
+    # seconds a shed client is asked to wait before retrying
+    RETRY_AFTER = 5
+    # requests taking at least this many milliseconds are logged to stderr, None to turn off
+    SLOW_REQUEST_MS = 1000
+    # development/test mode: statements repeated more than QUERY_REPEAT_THRESHOLD times in one request and
+    # endpoints over their query budget are reported, QUERY_CHECK_ACTION is 'warn' or 'raise'
+    QUERY_REPEAT_THRESHOLD = 5
+    QUERY_BUDGETS = {'lottery.view_draws': 3, 'lottery.check_draws': 3, 'lottery.add_draws': 4,
+                     'admin.view_all_users': 3, 'admin.view_winning_draw': 2, 'admin.run_lottery': 2,
+                     'admin.round_history': 2, 'admin.round_winners': 3, 'lottery.view_wins': 3}
+    QUERY_CHECK_ACTION = 'warn'
+    # security log: rotated by 'size' or 'time', records written in batches of up to LOG_BATCH_SIZE.
+    # with several worker processes every worker would rotate the file on its own, 'external' leaves rotation to
+    # a tool such as logrotate (renaming the file to LOG_FILE.1) and every worker appends to the current file
+    LOG_FILE = 'lottery.log'
+    LOG_ROTATION = 'size'
+    LOG_MAX_BYTES = 10 * 1024 * 1024
+    LOG_ROTATE_WHEN = 'midnight'
+    LOG_BACKUP_COUNT = 5
+    LOG_BATCH_SIZE = 100
+    # most draws accepted by one bulk submission
+    MAX_BULK_DRAWS = 1000
+    # largest request body in bytes, room for MAX_BULK_DRAWS lines of up to 64 bytes plus the rest of the form.
+    # a larger upload is turned away with a 413 before it is read
+    MAX_CONTENT_LENGTH = MAX_BULK_DRAWS * 64 + 16 * 1024
+    # rows per page of the user list and draw views
+    PAGE_SIZE = 50
+    # seconds a logged in user is cached for before being reloaded from the database
+    USER_CACHE_TTL = 60
+    # server-side key for the blind index of draws
+    DRAW_INDEX_KEY = 'LongAndRandomDrawIndexKey'
+    # lottery run: user draws played per batch, each batch is committed with the run's checkpoint
+    LOTTERY_CHUNK_SIZE = 5000
+    # lottery run: seconds without a committed batch after which another worker may take over an unfinished run
+    LOTTERY_RUN_TIMEOUT = 300
+    # lottery run: numbers a user draw must match to win a prize. (6,) plays for the jackpot only, which is
+    # found from the blind index without decrypting every draw
+    PRIZE_TIERS = (3, 4, 5, 6)
+    # lottery run: decryption of user draws, 'process' or 'thread' pool
+    DECRYPT_EXECUTOR = 'process'
+    DECRYPT_WORKERS = os.cpu_count() or 1
+    DECRYPT_BATCH_SIZE = 250
+    # rounds with fewer un-played user draws than this are decrypted serially
+    DECRYPT_SERIAL_THRESHOLD = 2000
+    # key rotation: users and draws per transaction
+    ROTATION_CHUNK_SIZE = 5000
+    # archival: played user draws of rounds before the latest ARCHIVE_KEEP_ROUNDS played rounds are moved to the
+    # archived_draws table, ARCHIVE_BATCH_SIZE draws per transaction
+    ARCHIVE_KEEP_ROUNDS = 3
+    ARCHIVE_BATCH_SIZE = 1000
 
-# initialise database
-db = SQLAlchemy(app)
 
 # Security Headers
 # custom Content Security Policy
@@ -58,7 +253,7 @@ csp = {
         'https://www.recaptcha.google.com.com/recaptcha/'
     ]
 }
-talisman = Talisman(app, content_security_policy=csp)
+talisman = Talisman()
 
 
 # DECORATORS
@@ -99,58 +294,44 @@ def requires_roles(*roles):
 
 
 # HOME PAGE VIEW
-@app.route('/')
 def index():
-    # view HTTP headers in the console
-    print(request.headers)
     return render_template('index.html')
 
 
 # error pages view
-@app.errorhandler(400)
 def bad_request(error):
     return render_template('errors/400.html'), 400
 
 
-@app.errorhandler(403)
 def page_forbidden(error):
     return render_template('errors/403.html'), 403
 
 
-@app.errorhandler(404)
 def page_not_found(error):
     return render_template('errors/404.html'), 404
 
 
-@app.errorhandler(500)
+def request_too_large(error):
+    return render_template('errors/413.html'), 413
+
+
 def internal_error(error):
     return render_template('errors/500.html'), 500
 
 
-@app.errorhandler(503)
 def service_unavailable(error):
-    return render_template('errors/503.html'), 503
+    return render_template('errors/503.html'), 503, {'Retry-After': str(current_app.config['RETRY_AFTER'])}
 
 
-if __name__ == "__main__":
-    my_host = "127.0.0.1"
-    free_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    free_socket.bind((my_host, 0))
-    free_socket.listen(5)
-    free_port = free_socket.getsockname()[1]
-    free_socket.close()
-
+# LOGIN MANAGER AND BLUEPRINTS
+def init_views(app):
     login_manager = LoginManager()
     login_manager.login_view = 'users.login'
     login_manager.init_app(app)
 
-    from models import User
-
-
-    @login_manager.user_loader
-    def load_user(id):
-        return User.query.get(int(id))
-
+    # users are loaded through a per-process cache
+    from users.cache import load_user
+    login_manager.user_loader(load_user)
 
     # BLUEPRINTS
     # import blueprints
@@ -163,4 +344,72 @@ if __name__ == "__main__":
     app.register_blueprint(admin_blueprint)
     app.register_blueprint(lottery_blueprint)
 
+
+# APPLICATION FACTORY
+# apps created in this process, their database engines are disposed in forked worker processes
+apps = []
+
+
+def create_app(config=None):
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    if config:
+        app.config.from_mapping(config)
+
+    # initialise logging, once per process
+    init_logging(app.config)
+
+    # initialise database
+    init_database(app)
+
+    # Security Headers
+    talisman.init_app(app, content_security_policy=csp)
+
+    # Request instrumentation, registered first so shed requests are counted too
+    init_metrics(app)
+    # N+1 query detection in development/test mode
+    init_query_checks(app)
+    # Load shedding
+    init_limiter(app)
+
+    app.add_url_rule('/', 'index', index)
+    app.register_error_handler(400, bad_request)
+    app.register_error_handler(403, page_forbidden)
+    app.register_error_handler(404, page_not_found)
+    app.register_error_handler(413, request_too_large)
+    app.register_error_handler(500, internal_error)
+    app.register_error_handler(503, service_unavailable)
+
+    init_views(app)
+    # Management commands
+    init_commands(app)
+
+    apps.append(app)
+    return app
+
+
+# FORK SAFETY
+# a worker forked from a process that already used the database (e.g. gunicorn --preload) must open its own
+# connections, and needs its own log listener thread since threads do not survive a fork
+def after_fork_in_child():
+    for app in apps:
+        dispose_engines(app)
+    restart_logging()
+
+
+os.register_at_fork(after_in_child=after_fork_in_child)
+
+
+if __name__ == "__main__":
+    my_host = "127.0.0.1"
+    free_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    free_socket.bind((my_host, 0))
+    free_socket.listen(5)
+    free_port = free_socket.getsockname()[1]
+    free_socket.close()
+
+    # imported by module name so the views share this module, not a second copy under __main__
+    import app as application
+    app = application.create_app()
+
     app.run(host=my_host, port=free_port, debug=True, ssl_context=('cert.pem', 'key.pem'))
@@ -0,0 +1,62 @@
+# IMPORTS
+import time
+from datetime import datetime
+from flask import current_app
+from sqlalchemy import func, literal
+from database import db
+from models import Draw, ArchivedDraw, RoundResult
+
+# CONFIG
+# columns copied from draws, and the archived_draws columns they are copied to
+DRAW_COLUMNS = ('id', 'user_id', 'draw', 'match', 'round', 'draw_index')
+ARCHIVED_COLUMNS = ('draw_id', 'user_id', 'draw', 'match', 'round', 'draw_index')
+
+
+# last round whose played draws are archived: the latest played round less the rounds kept, None if there is none
+def archive_cutoff(keep_rounds):
+    latest = db.session.query(func.max(RoundResult.round)).scalar()
+    if latest is None or latest <= keep_rounds:
+        return None
+    return latest - keep_rounds
+
+
+# move played user draws of rounds before the latest keep_rounds played rounds to archived_draws.
+# draws are copied and deleted batch_size at a time, one short transaction per batch, so the views and lottery
+# runs only wait for one batch. progress is called with (draws archived, seconds) after every batch.
+# returns the number of draws archived
+def archive_draws(keep_rounds=None, batch_size=None, progress=None):
+    config = current_app.config
+    keep_rounds = config['ARCHIVE_KEEP_ROUNDS'] if keep_rounds is None else keep_rounds
+    batch_size = batch_size or config['ARCHIVE_BATCH_SIZE']
+    progress = progress or (lambda rows, seconds: None)
+
+    cutoff = archive_cutoff(keep_rounds)
+    if cutoff is None:
+        return 0
+
+    draws = Draw.__table__
+    archived_on = literal(datetime.now(), ArchivedDraw.archived_on.type)
+
+    archived = 0
+    last_id = 0
+    start = time.perf_counter()
+    while True:
+        batch = [draw_id for draw_id, in db.session.query(Draw.id)
+                 .filter(Draw.win == False, Draw.played == True, Draw.round <= cutoff, Draw.id > last_id)
+                 .order_by(Draw.id)
+                 .limit(batch_size)]
+
+        if not batch:
+            break
+
+        # the copy and the delete are one transaction, a draw is either in draws or in archived_draws
+        copy = db.select([draws.c[name] for name in DRAW_COLUMNS] + [archived_on]) \
+            .where(draws.c.id.in_(batch))
+        db.session.execute(ArchivedDraw.__table__.insert().from_select(ARCHIVED_COLUMNS + ('archived_on',), copy))
+        # draws a user deleted with play_again since the batch was selected are not counted
+        archived += db.session.execute(draws.delete().where(draws.c.id.in_(batch))).rowcount
+        db.session.commit()
+        last_id = batch[-1]
+        progress(archived, time.perf_counter() - start)
+
+    return archived
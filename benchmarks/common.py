@@ -0,0 +1,17 @@
+# IMPORTS
+import os
+import tempfile
+
+
+# value below which p percent of values fall, nearest rank
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+# make a scratch directory and move into it, so the database and security log the app creates land there.
+# app must be imported after this. returns the directory
+def scratch_dir(prefix):
+    workdir = tempfile.mkdtemp(prefix=prefix)
+    os.chdir(workdir)
+    return workdir
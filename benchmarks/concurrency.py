@@ -0,0 +1,122 @@
+# IMPORTS
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.common import percentile, scratch_dir
+
+# CONFIG
+BASE_URL = 'https://localhost'
+
+
+# concurrency check: readers keep loading /view_draws and /check_draws while a lottery run holds the write
+# transaction open. exits with status 1 if the readers made no progress during the write or saw any errors
+def main():
+    parser = argparse.ArgumentParser(description='Check that readers make progress while a lottery run is writing.')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--draws', type=int, default=20, help='draws per user')
+    parser.add_argument('--readers', type=int, default=4, help='concurrent reader threads')
+    parser.add_argument('--hold', type=float, default=2.0,
+                        help='seconds the lottery run keeps its write transaction open before running the round')
+    args = parser.parse_args()
+
+    workdir = scratch_dir('lottery-concurrency-')
+
+    from app import create_app
+    from database import db
+    from models import User, Draw
+    from admin.engine import run_round
+    from benchmarks.seed import seed, add_winning_draw
+
+    app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(workdir, 'lottery.db'),
+                      'TESTING': True})
+
+    with app.app_context():
+        users = seed(args.users, args.draws)
+        add_winning_draw(round=2)
+
+    writing = threading.Event()
+    done = threading.Event()
+    writer = {}
+
+    # the lottery run: take the write lock with an update and keep the transaction open for --hold seconds, then
+    # play the round. claiming the round commits the held update, and every batch of the round is then committed
+    # in its own transaction
+    def write():
+        with app.app_context():
+            try:
+                winning_draw = Draw.query.filter_by(win=True, played=False).first()
+                winning_key = User.query.filter_by(role='admin').first().draw_key
+                start = time.perf_counter()
+                Draw.query.filter(Draw.win == False, Draw.played == False) \
+                    .update({Draw.match: False}, synchronize_session=False)
+                writing.set()
+                time.sleep(args.hold)
+                results, stats = run_round(winning_draw, winning_key)
+                writer['seconds'] = time.perf_counter() - start
+                writer['rows_updated'] = stats.rows_updated
+            except Exception as e:
+                writer['error'] = repr(e)
+            finally:
+                writing.clear()
+                done.set()
+                db.session.remove()
+
+    reads = []
+    errors = []
+    lock = threading.Lock()
+
+    def read(user_id):
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(user_id)
+            session['_fresh'] = True
+
+        while not done.is_set():
+            for url in ('/view_draws', '/check_draws'):
+                during_write = writing.is_set()
+                start = time.perf_counter()
+                try:
+                    status = client.post(url, base_url=BASE_URL).status_code
+                except Exception as e:
+                    status = repr(e)
+                latency = time.perf_counter() - start
+                with lock:
+                    if status == 200:
+                        reads.append((during_write and writing.is_set(), latency))
+                    else:
+                        errors.append('%s %s' % (url, status))
+
+    readers = [threading.Thread(target=read, args=(users[i % len(users)],)) for i in range(args.readers)]
+    writer_thread = threading.Thread(target=write)
+    writer_thread.start()
+    writing.wait(timeout=10)
+    for reader in readers:
+        reader.start()
+    writer_thread.join()
+    for reader in readers:
+        reader.join()
+
+    latencies = [latency for during_write, latency in reads if during_write]
+    report = {'readers': args.readers,
+              'writer': writer,
+              'reads': len(reads),
+              # reads that started and finished while the write transaction was open
+              'reads_during_write': len(latencies),
+              'read_p50_ms': percentile(latencies, 50) * 1000 if latencies else None,
+              'read_p95_ms': percentile(latencies, 95) * 1000 if latencies else None,
+              'errors': errors[:10],
+              'error_count': len(errors)}
+    print(json.dumps(report, indent=2))
+
+    sys.exit(0 if latencies and not errors and 'error' not in writer else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+# IMPORTS
+import argparse
+import json
+import os
+import shutil
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.common import scratch_dir
+
+# CONFIG
+# where in the commit of a batch the process is killed: before the batch's changes are flushed, flushed into
+# the open transaction but not committed, or committed but not yet returned to the run
+CRASH_POINTS = ('before_commit', 'after_flush', 'after_commit')
+
+
+# crash-injection check for checkpointed lottery runs: the same round is played on copies of a seeded database,
+# once uninterrupted and, for every crash point, in a process killed partway through and then resumed.
+# exits with status 1 if a resumed run's results, draws or history differ, or if it read finished batches again
+def main():
+    parser = argparse.ArgumentParser(description='Check that an interrupted lottery run resumes to the same results.')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--draws', type=int, default=10, help='draws per user')
+    parser.add_argument('--chunk', type=int, default=100, help='draws per checkpointed batch')
+    parser.add_argument('--crash-after', type=int, default=3, help='batches committed before the crash')
+    parser.add_argument('--crash-at', choices=CRASH_POINTS, action='append',
+                        help='point in the commit where the process is killed, every point if not given')
+    args = parser.parse_args()
+
+    workdir = scratch_dir('lottery-crash-')
+
+    from sqlalchemy import event, text
+    from app import create_app
+    from database import db
+    from models import User, Draw, LotteryRun, cipher_cache, decrypt, draw_row
+    from admin.engine import run_round
+    from benchmarks.seed import seed, add_winning_draw
+
+    def database(name):
+        # threads, so the killed process leaves no orphaned decryption workers behind. the killed process cannot
+        # give up its claim on the run, it is taken over straight away instead of after the usual timeout
+        return create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(workdir, name),
+                           'TESTING': True, 'DECRYPT_EXECUTOR': 'thread', 'LOTTERY_RUN_TIMEOUT': 0})
+
+    reference = database('reference.db')
+    with reference.app_context():
+        users = seed(args.users, args.draws)
+        admin_id = add_winning_draw(round=2)
+        admin = db.session.get(User, admin_id)
+        winning_numbers = decrypt(Draw.query.filter_by(win=True).first().draw, admin.draw_key)
+
+        # every tenth user also enters the winning numbers
+        rows = []
+        for user_id, draw_key in db.session.query(User.id, User.draw_key).filter(User.id.in_(users[::10])):
+            rows.append(draw_row(user_id, winning_numbers, win=False, round=0, cipher=cipher_cache.get(draw_key)))
+        db.session.execute(Draw.__table__.insert(), rows)
+        # a third of the draws are treated as entered before the blind index, so they are decrypted
+        db.session.execute(text('UPDATE draws SET draw_index = NULL WHERE win = 0 AND id % 3 = 0'))
+        db.session.commit()
+        db.engine.dispose()
+    # every crash is played on a copy of the seeded database
+    shutil.copy(os.path.join(workdir, 'reference.db'), os.path.join(workdir, 'seeded.db'))
+
+    def play(app):
+        with app.app_context():
+            winning_draw = Draw.query.filter_by(win=True, played=False).first()
+            return run_round(winning_draw, db.session.get(User, admin_id).draw_key, chunk_size=args.chunk)
+
+    # state of the round after the run: every draw's flags, the winners and the round's result
+    def snapshot(app):
+        with app.app_context():
+            return {'draws': [list(row) for row in db.session.execute(
+                        text('SELECT id, played, "match", round FROM draws ORDER BY id'))],
+                    'winners': [list(row) for row in db.session.execute(
+                        text('SELECT round, user_id, draw_id, matches FROM winners ORDER BY draw_id'))],
+                    'round_results': [list(row) for row in db.session.execute(
+                        text('SELECT round, winning_draw, entries, winners FROM round_results ORDER BY round'))]}
+
+    # the process is killed (no clean up, no rollback) at the crash point of the batch after --crash-after
+    # batches, then the round is run again
+    def crash_and_resume(point):
+        name = 'crash-%s.db' % point
+        shutil.copy(os.path.join(workdir, 'seeded.db'), os.path.join(workdir, name))
+        crash = database(name)
+
+        pid = os.fork()
+        if pid == 0:
+            with crash.app_context():
+                commits = []
+
+                def count(session):
+                    commits.append(1)
+
+                def kill(session, *event_args):
+                    # the first commit starts the run
+                    if len(commits) > args.crash_after + 1:
+                        os._exit(1)
+
+                session = db.session()
+                event.listen(session, 'before_commit', count)
+                event.listen(session, point, kill)
+                winning_draw = Draw.query.filter_by(win=True, played=False).first()
+                run_round(winning_draw, db.session.get(User, admin_id).draw_key, chunk_size=args.chunk)
+            os._exit(0)
+        crashed = os.waitpid(pid, 0)[1] != 0
+
+        with crash.app_context():
+            checkpoint = LotteryRun.query.filter_by(round=2).first()
+            checkpoint = {'last_draw_id': checkpoint.last_draw_id, 'processed': checkpoint.processed,
+                          'entries': checkpoint.entries} if checkpoint else None
+
+        resumed_results, resumed_stats = play(crash)
+        report = {'crashed': crashed,
+                  'checkpoint': checkpoint,
+                  'results_match': resumed_results == results,
+                  'state_match': snapshot(crash) == snapshot(reference),
+                  'resumed_rows_read': resumed_stats.rows_read}
+        ok = crashed and checkpoint and checkpoint['processed'] > 0 and report['results_match'] \
+            and report['state_match'] and resumed_stats.rows_read < stats.rows_read
+        return report, ok
+
+    results, stats = play(reference)
+    report = {'winners': len(results), 'rows_read': stats.rows_read, 'crashes': {}}
+    ok = True
+    for point in args.crash_at or CRASH_POINTS:
+        report['crashes'][point], point_ok = crash_and_resume(point)
+        ok = ok and point_ok
+
+    print(json.dumps(report, indent=2))
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
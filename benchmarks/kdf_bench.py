@@ -0,0 +1,85 @@
+# IMPORTS
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.common import percentile, scratch_dir
+
+# the database and security log the app creates go to a scratch directory, not the working tree
+scratch_dir('lottery-kdf-')
+
+import kdf
+from app import create_app
+
+app = create_app()
+
+# CONFIG
+# (scrypt N, password hash method) pairs to compare
+COST_SETTINGS = [
+    (2 ** 12, 'pbkdf2:sha256:100000'),
+    (2 ** 13, 'pbkdf2:sha256:150000'),
+    (2 ** 14, 'pbkdf2:sha256:260000'),
+    (2 ** 15, 'pbkdf2:sha256:390000'),
+]
+PASSWORD = 'Benchmark1!'
+
+
+# registrations/sec and login latency for one cost setting, with clients concurrent requests
+def bench_setting(scrypt_n, method, registrations, logins, clients):
+    app.config['KDF_SCRYPT_N'] = scrypt_n
+    app.config['PASSWORD_HASH_METHOD'] = method
+    # a fresh pool so every setting starts with the same workers and an empty queue
+    kdf.pool = None
+
+    def register(_):
+        with app.app_context():
+            kdf.derive_draw_key(PASSWORD)
+            kdf.hash_password(PASSWORD)
+
+    def login(pwhash):
+        with app.app_context():
+            start = time.perf_counter()
+            kdf.check_password(pwhash, PASSWORD)
+            return time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=clients) as client_pool:
+        start = time.perf_counter()
+        list(client_pool.map(register, range(registrations)))
+        registration_time = time.perf_counter() - start
+
+        with app.app_context():
+            pwhash = kdf.hash_password(PASSWORD)
+        latencies = list(client_pool.map(login, [pwhash] * logins))
+
+    return {'scrypt_n': scrypt_n,
+            'hash_method': method,
+            'registrations_per_sec': registrations / registration_time,
+            'login_p50_ms': percentile(latencies, 50) * 1000,
+            'login_p99_ms': percentile(latencies, 99) * 1000}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Registrations/sec and login p99 for each KDF cost setting.')
+    parser.add_argument('--registrations', type=int, default=64)
+    parser.add_argument('--logins', type=int, default=200)
+    parser.add_argument('--clients', type=int, default=16, help='concurrent requests')
+    parser.add_argument('--workers', type=int, default=app.config['KDF_WORKERS'], help='KDF_WORKERS')
+    args = parser.parse_args()
+
+    app.config['KDF_WORKERS'] = args.workers
+    # every concurrent request is allowed to wait for a worker
+    app.config['KDF_QUEUE_DEPTH'] = args.clients
+
+    print('%-8s %-24s %10s %12s %12s' % ('scrypt N', 'hash method', 'reg/s', 'login p50', 'login p99'))
+    for scrypt_n, method in COST_SETTINGS:
+        result = bench_setting(scrypt_n, method, args.registrations, args.logins, args.clients)
+        print('%-8d %-24s %10.1f %10.1fms %10.1fms' % (scrypt_n, method, result['registrations_per_sec'],
+                                                       result['login_p50_ms'], result['login_p99_ms']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+# IMPORTS
+import argparse
+import json
+import os
+import random
+import re
+import resource
+import statistics
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.common import percentile, scratch_dir
+
+# CONFIG
+BASE_URL = 'https://localhost'
+# seconds to wait for a lottery run job to finish
+JOB_TIMEOUT = 600
+
+
+# counts every SQL statement sent to the database
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, *args):
+        self.count += 1
+
+
+def csrf_token(client, url):
+    page = client.get(url, base_url=BASE_URL).data.decode('utf-8')
+    return re.search(r'name="csrf_token" type="hidden" value="([^"]+)"', page).group(1)
+
+
+def draw_form(rng):
+    return {'no%d' % (i + 1): str(n) for i, n in enumerate(rng.sample(range(1, 61), 6))}
+
+
+# run prepare(i) untimed and send(prepared) timed for every iteration.
+# send returns (response, units of work), throughput is reported in units per second
+def measure(counter, iterations, prepare, send):
+    latencies = []
+    queries = []
+    units = 0
+    errors = 0
+    for i in range(iterations):
+        prepared = prepare(i)
+        before = counter.count
+        start = time.perf_counter()
+        response, work = send(prepared)
+        latencies.append(time.perf_counter() - start)
+        queries.append(counter.count - before)
+        units += work
+        if response.status_code >= 400:
+            errors += 1
+
+    return {'iterations': iterations,
+            'throughput_per_sec': units / sum(latencies),
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p95_ms': percentile(latencies, 95) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+            'queries_per_request': statistics.mean(queries),
+            'errors': errors}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Seed a synthetic database and benchmark the lottery endpoints.')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--draws', type=int, default=20, help='draws per user')
+    parser.add_argument('--iterations', type=int, default=50, help='requests per endpoint')
+    parser.add_argument('--runs', type=int, default=3, help='lottery runs')
+    parser.add_argument('--output', default='bench_results.json')
+    args = parser.parse_args()
+    output = os.path.abspath(args.output)
+
+    workdir = scratch_dir('lottery-bench-')
+
+    import pyotp
+    from sqlalchemy import event
+    from app import create_app
+    from database import db
+    from models import Draw
+    from benchmarks.seed import seed, add_winning_draw, PASSWORD, PIN_KEY
+
+    app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.join(workdir, 'lottery.db'),
+                      # no reCAPTCHA round trip
+                      'TESTING': True,
+                      # the benchmark logs in far more often than a real client
+                      'LOGIN_IP_BURST': 10 ** 9, 'LOGIN_ACCOUNT_BURST': 10 ** 9})
+    rng = random.Random(2031)
+
+    with app.app_context():
+        start = time.perf_counter()
+        users = seed(args.users, args.draws)
+        seed_time = time.perf_counter() - start
+        # views that only read use the read engine, its statements are counted too
+        counter = QueryCounter()
+        for engine in {db.engine, app.extensions['read_engine']}:
+            event.listen(engine, 'before_cursor_execute', counter)
+
+    def user_client(user_id):
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(user_id)
+            session['_fresh'] = True
+        return client
+
+    def post(client, url, data=None):
+        return client.post(url, data=data or {}, base_url=BASE_URL)
+
+    results = {}
+
+    # user pages
+    results['view_draws'] = measure(counter, args.iterations,
+                                    lambda i: user_client(rng.choice(users)),
+                                    lambda client: (post(client, '/view_draws'), 1))
+    results['check_draws'] = measure(counter, args.iterations,
+                                     lambda i: user_client(rng.choice(users)),
+                                     lambda client: (post(client, '/check_draws'), 1))
+
+    # lottery runs, draws played by the previous run are entered again first
+    with app.app_context():
+        admin_id = add_winning_draw(round=2)
+    admin = user_client(admin_id)
+
+    def prepare_run(i):
+        with app.app_context():
+            Draw.query.filter(Draw.win == False, Draw.round == 2) \
+                .update({Draw.played: False, Draw.match: False, Draw.round: 0}, synchronize_session=False)
+            db.session.commit()
+            add_winning_draw(round=2, seed=i)
+        return admin
+
+    def run_lottery(client):
+        response = post(client, '/run_lottery')
+        round = re.search(r'name="round" value="(\d+)"', response.data.decode('utf-8')).group(1)
+        deadline = time.monotonic() + JOB_TIMEOUT
+        while time.monotonic() < deadline:
+            response = client.get('/lottery_job/' + round, base_url=BASE_URL)
+            job = response.get_json()
+            if job['status'] not in ('queued', 'running'):
+                break
+            time.sleep(0.01)
+        # throughput of a lottery run is in draws per second
+        return response, job['total']
+
+    results['run_lottery'] = measure(counter, args.runs, prepare_run, run_lottery)
+
+    results['add_draw'] = measure(counter, args.iterations,
+                                  lambda i: user_client(rng.choice(users)),
+                                  lambda client: (post(client, '/add_draw', draw_form(rng)), 1))
+
+    # login and registration through the real forms
+    def prepare_form(url):
+        def prepare(i):
+            client = app.test_client()
+            return client, csrf_token(client, url), i
+        return prepare
+
+    def login(prepared):
+        client, token, i = prepared
+        return post(client, '/login', {'csrf_token': token, 'email': 'user%d@email.com' % (i % args.users),
+                                       'password': PASSWORD, 'pin': pyotp.TOTP(PIN_KEY).now()}), 1
+
+    def register(prepared):
+        client, token, i = prepared
+        return post(client, '/register', {'csrf_token': token, 'email': 'new%d@email.com' % i,
+                                          'firstname': 'New', 'lastname': 'User', 'phone': '0191-123-4567',
+                                          'password': PASSWORD, 'confirm_password': PASSWORD,
+                                          'pin_key': PIN_KEY}), 1
+
+    results['login'] = measure(counter, args.iterations, prepare_form('/login'), login)
+    results['register'] = measure(counter, args.iterations, prepare_form('/register'), register)
+
+    report = {'users': args.users,
+              'draws_per_user': args.draws,
+              'seed_seconds': seed_time,
+              'results': results,
+              # kilobytes on Linux, children are the decryption worker processes
+              'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+              'peak_rss_children_kb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss}
+
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
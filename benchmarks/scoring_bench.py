@@ -0,0 +1,64 @@
+# IMPORTS
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from admin.scoring import count_matches, draw_mask, encode_draws
+
+# CONFIG
+WINNING_DRAW = '7 14 21 28 35 42'
+TIERS = (3, 4, 5, 6)
+
+
+def random_draw(rng):
+    return ' '.join(str(n) for n in rng.sample(range(1, 61), 6)) + ' '
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+# the per-row Python loop: the numbers each draw has in common with the winning draw
+def python_scores(draws):
+    winning = set(WINNING_DRAW.split())
+    return [len(winning.intersection(draw.split())) for draw in draws]
+
+
+# draws scored per second by the per-row loop and by the bitmask encoding, in chunks as the lottery run does
+def main():
+    parser = argparse.ArgumentParser(description='Draws scored per second: per-row Python loop vs NumPy bitmasks.')
+    parser.add_argument('--draws', type=int, default=1000000)
+    parser.add_argument('--chunk', type=int, default=5000, help='draws per batch (LOTTERY_CHUNK_SIZE)')
+    args = parser.parse_args()
+
+    rng = random.Random(2031)
+    draws = [random_draw(rng) for _ in range(args.draws)]
+    chunks = [draws[i:i + args.chunk] for i in range(0, len(draws), args.chunk)]
+    winning_mask = draw_mask(WINNING_DRAW)
+
+    expected, loop_time = timed(lambda: [score for chunk in chunks for score in python_scores(chunk)])
+    masks, encode_time = timed(lambda: [encode_draws(chunk) for chunk in chunks])
+    counts, count_time = timed(lambda: [count_matches(chunk, winning_mask) for chunk in masks])
+
+    counts = np.concatenate(counts)
+    if counts.tolist() != expected:
+        sys.exit('bitmask scores differ from the per-row loop')
+
+    print('%-28s %14s' % ('', 'draws/s'))
+    print('%-28s %14.0f' % ('per-row Python loop', args.draws / loop_time))
+    print('%-28s %14.0f' % ('bitmask encode + count', args.draws / (encode_time + count_time)))
+    print('%-28s %14.0f' % ('bitmask count only', args.draws / count_time))
+    print()
+    for tier in TIERS:
+        print('%d numbers matched: %d draws' % (tier, np.count_nonzero(counts == tier)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+# IMPORTS
+import random
+from datetime import datetime
+from cryptography.fernet import Fernet
+from database import db
+from kdf import hash_password
+from models import User, Draw, cipher_cache, draw_row, init_db
+
+# CONFIG
+# every seeded user shares this password and PIN key so the benchmarks can log in as any of them
+PASSWORD = 'Benchmark1!'
+PIN_KEY = 'BFB5S34STBLZCOB22K6PPYDCMZMH46OJ'
+# rows per executemany
+BATCH_SIZE = 5000
+
+
+def random_draw(rng):
+    return ' '.join(str(n) for n in rng.sample(range(1, 61), 6)) + ' '
+
+
+# create a fresh database with the admin, n users and draws_per_user draws each, inserted in bulk.
+# users get a random draw key instead of the scrypt derivation and share one password hash.
+# half of each user's draws are already played in round 1, the rest are entered for round 2.
+# returns the ids of the seeded users. run inside an app context
+def seed(users, draws_per_user, seed=2031):
+    rng = random.Random(seed)
+    init_db()
+
+    pwhash = hash_password(PASSWORD)
+    now = datetime.now()
+    user_rows = [{'email': 'user%d@email.com' % i, 'password': pwhash, 'pin_key': PIN_KEY,
+                  'registered_on': now, 'firstname': 'Bench', 'lastname': 'User%d' % i,
+                  'phone': '0191-123-4567', 'role': 'user', 'draw_key': Fernet.generate_key()}
+                 for i in range(users)]
+    for i in range(0, len(user_rows), BATCH_SIZE):
+        db.session.execute(User.__table__.insert(), user_rows[i:i + BATCH_SIZE])
+    db.session.commit()
+
+    seeded = db.session.query(User.id, User.draw_key).filter(User.role == 'user').order_by(User.id).all()
+    draw_rows = []
+    for user_id, draw_key in seeded:
+        cipher = cipher_cache.get(draw_key)
+        for i in range(draws_per_user):
+            row = draw_row(user_id, random_draw(rng), win=False, round=0, cipher=cipher)
+            if i % 2:
+                row.update(played=True, round=1)
+            draw_rows.append(row)
+
+        if len(draw_rows) >= BATCH_SIZE:
+            db.session.execute(Draw.__table__.insert(), draw_rows)
+            draw_rows = []
+    if draw_rows:
+        db.session.execute(Draw.__table__.insert(), draw_rows)
+    db.session.commit()
+
+    return [user_id for user_id, draw_key in seeded]
+
+
+# add an un-played winning draw for the given round, entered by the admin
+def add_winning_draw(round, seed=2031):
+    admin = User.query.filter_by(role='admin').first()
+    Draw.query.filter_by(win=True).delete()
+    db.session.add(Draw(user_id=admin.id, draw=random_draw(random.Random(seed)), win=True, round=round,
+                        draw_key=admin.draw_key))
+    db.session.commit()
+    return admin.id
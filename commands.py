@@ -0,0 +1,78 @@
+# IMPORTS
+import click
+from archive import archive_draws
+from migrations import upgrade_db, schema_version
+from rotation import user_ids_for, pending_user_ids, rotate_keys, reencrypt_draws
+
+# CONFIG
+# most undecryptable draws listed by a re-encryption
+MAX_REPORTED = 20
+
+
+def report_progress(rows, seconds):
+    click.echo('%d draws re-encrypted, %.0f rows/s' % (rows, rows / seconds if seconds else 0))
+
+
+def report_failed(failed):
+    if not failed:
+        return
+    click.echo('%d draws could not be decrypted with their owner\'s keys and were left as they are, '
+               'their owners keep their previous key:' % len(failed))
+    for table, draw_id in failed[:MAX_REPORTED]:
+        click.echo('  %s id %d' % (table, draw_id))
+    if len(failed) > MAX_REPORTED:
+        click.echo('  and %d more' % (len(failed) - MAX_REPORTED))
+
+
+def report_archived(rows, seconds):
+    click.echo('%d draws archived, %.0f rows/s' % (rows, rows / seconds if seconds else 0))
+
+
+# register the management commands with the app, e.g.
+#   FLASK_APP=wsgi flask rotate-keys --user someone@email.com
+def init_commands(app):
+    @app.cli.command('upgrade-db', help='Bring the database up to the latest schema.')
+    def upgrade_db_command():
+        upgrade_db()
+        click.echo('Database schema is at version %d.' % schema_version())
+
+    @app.cli.command('rotate-keys', help='Give users new draw keys and re-encrypt their draws.')
+    @click.option('--user', 'emails', multiple=True, help='Email of a user to rotate, every user if not given.')
+    @click.option('--chunk-size', type=int, help='Users and draws per transaction.')
+    @click.option('--workers', type=int, help='Re-encryption workers.')
+    def rotate_keys_command(emails, chunk_size, workers):
+        user_ids = user_ids_for(emails)
+
+        # a rotation that did not finish, e.g. an interrupted run of this command, is finished first
+        pending = pending_user_ids(user_ids)
+        if pending:
+            click.echo('Finishing the previous rotation of %d users.' % len(pending))
+            rows, failed = reencrypt_draws(pending, chunk_size, workers, progress=report_progress)
+            report_failed(failed)
+
+        skipped = pending_user_ids(user_ids)
+        users = rotate_keys(user_ids, chunk_size)
+        click.echo('Draw keys of %d users rotated.' % users)
+        if skipped:
+            click.echo('Draw keys of %d users not rotated, their previous rotation has not finished.' % len(skipped))
+
+        rows, failed = reencrypt_draws(user_ids, chunk_size, workers, progress=report_progress)
+        report_failed(failed)
+        click.echo('Done, %d draws re-encrypted.' % rows)
+
+    @app.cli.command('reencrypt-draws', help="Re-encrypt draws with their owner's current draw key, e.g. to finish "
+                                             "an interrupted rotation.")
+    @click.option('--user', 'emails', multiple=True, help='Email of a user to re-encrypt, every user if not given.')
+    @click.option('--chunk-size', type=int, help='Draws per transaction.')
+    @click.option('--workers', type=int, help='Re-encryption workers.')
+    def reencrypt_draws_command(emails, chunk_size, workers):
+        rows, failed = reencrypt_draws(user_ids_for(emails), chunk_size, workers, progress=report_progress)
+        report_failed(failed)
+        click.echo('Done, %d draws re-encrypted.' % rows)
+
+    @app.cli.command('archive-draws', help='Move played draws of old rounds to the archive.')
+    @click.option('--keep-rounds', type=int, help='Latest played rounds whose draws are not archived.')
+    @click.option('--batch-size', type=int, help='Draws per transaction.')
+    def archive_draws_command(keep_rounds, batch_size):
+        rows = archive_draws(keep_rounds, batch_size, progress=report_archived)
+        click.echo('Done, %d draws archived.' % rows)
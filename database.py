@@ -0,0 +1,84 @@
+# IMPORTS
+import threading
+from flask import current_app
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import Session, scoped_session
+from sqlalchemy.pool import QueuePool
+
+# database, initialised with the app by init_database
+db = SQLAlchemy()
+
+# session for read-only views, bound to the app's read engine and removed at the end of every request
+read_session = scoped_session(lambda: Session(bind=current_app.extensions['read_engine'], autoflush=False),
+                              scopefunc=threading.get_ident)
+
+
+def is_sqlite(url):
+    return url.get_backend_name() == 'sqlite'
+
+
+def is_memory(url):
+    return url.database in (None, '', ':memory:')
+
+
+# engine options for a file database: a pool of pool_size connections plus max_overflow extra ones, shared
+# between threads. in-memory databases keep flask-sqlalchemy's single static connection
+def engine_options(config, url, pool_size):
+    if is_sqlite(url) and is_memory(url):
+        return {}
+    options = {'poolclass': QueuePool,
+               'pool_size': pool_size,
+               'max_overflow': config['DB_MAX_OVERFLOW'],
+               'pool_timeout': config['DB_POOL_TIMEOUT']}
+    if is_sqlite(url):
+        # a pooled connection is handed to one thread at a time
+        options['connect_args'] = {'check_same_thread': False}
+    return options
+
+
+# set the pragmas on every new connection of a SQLite engine
+def set_pragmas(engine, pragmas):
+    @event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute('PRAGMA %s = %s' % (name, value))
+        cursor.close()
+
+
+# bind the database to the app and create its engines.
+# writes go through db.session, views that only read use read_session, which has its own connection pool so
+# readers are not queued behind a long write. with WAL journaling they also do not wait for it to commit
+def init_database(app):
+    config = app.config
+    config['SQLALCHEMY_ENGINE_OPTIONS'] = dict(
+        engine_options(config, make_url(config['SQLALCHEMY_DATABASE_URI']), config['DB_POOL_SIZE']),
+        **config.get('SQLALCHEMY_ENGINE_OPTIONS', {}))
+    db.init_app(app)
+
+    with app.app_context():
+        engine = db.engine
+    url = engine.url
+
+    if is_sqlite(url) and is_memory(url):
+        # a second engine would open a different in-memory database
+        read_engine = engine
+    else:
+        read_engine = create_engine(url, **engine_options(config, url, config['DB_READ_POOL_SIZE']))
+
+    if is_sqlite(url):
+        set_pragmas(engine, config['SQLITE_PRAGMAS'])
+        if read_engine is not engine:
+            set_pragmas(read_engine, dict(config['SQLITE_PRAGMAS'], query_only='ON'))
+    app.extensions['read_engine'] = read_engine
+
+    app.teardown_appcontext(lambda exception: read_session.remove())
+
+
+# a forked worker opens its own connections, the parent's connections are left open for the parent
+def dispose_engines(app):
+    with app.app_context():
+        db.engine.dispose(close=False)
+    app.extensions['read_engine'].dispose(close=False)
@@ -0,0 +1,75 @@
+# IMPORTS
+import base64
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from Crypto.Protocol.KDF import scrypt
+from Crypto.Random import get_random_bytes
+from flask import current_app
+from werkzeug.security import generate_password_hash, check_password_hash
+from metrics import timed
+
+
+# raised when the key derivation queue is full, the request is turned away instead of waiting
+class KdfBusy(Exception):
+    pass
+
+
+# bounded worker pool for password hashing and key derivation.
+# at most workers + queue_depth derivations are running or waiting at any time
+class KdfPool:
+    def __init__(self, workers, queue_depth):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='kdf')
+        self.slots = threading.BoundedSemaphore(workers + queue_depth)
+        self.rejected = 0
+
+    def run(self, func, *args, **kwargs):
+        if not self.slots.acquire(blocking=False):
+            self.rejected += 1
+            raise KdfBusy()
+        try:
+            return self.executor.submit(func, *args, **kwargs).result()
+        finally:
+            self.slots.release()
+
+
+pool = None
+pool_lock = threading.Lock()
+
+
+# worker threads do not survive a fork, a forked process creates its own pool
+def reset_pool():
+    global pool, pool_lock
+    pool = None
+    pool_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=reset_pool)
+
+
+# the process' pool, created on first use from the app config
+def get_pool():
+    global pool
+    with pool_lock:
+        if pool is None:
+            pool = KdfPool(current_app.config['KDF_WORKERS'], current_app.config['KDF_QUEUE_DEPTH'])
+        return pool
+
+
+# generate a user's draw key from their password
+def derive_draw_key(password):
+    config = current_app.config
+    with timed('kdf'):
+        return get_pool().run(lambda: base64.urlsafe_b64encode(
+            scrypt(password, str(get_random_bytes(32)), 32,
+                   N=config['KDF_SCRYPT_N'], r=config['KDF_SCRYPT_R'], p=config['KDF_SCRYPT_P'])))
+
+
+def hash_password(password):
+    with timed('kdf'):
+        return get_pool().run(generate_password_hash, password, method=current_app.config['PASSWORD_HASH_METHOD'])
+
+
+def check_password(pwhash, password):
+    with timed('kdf'):
+        return get_pool().run(check_password_hash, pwhash, password)
@@ -0,0 +1,63 @@
+# IMPORTS
+import threading
+from flask import abort, current_app, g, request
+
+
+# caps the requests in flight in this worker, overall and for expensive endpoints.
+# a request over a cap is shed straight away instead of queueing behind SQLite locks and key derivation
+class ConcurrencyLimiter:
+    def __init__(self):
+        self.in_flight = {}
+        self.shed = {}
+        self._lock = threading.Lock()
+
+    # admit a request against every (name, limit) pair, or none of them
+    def try_acquire(self, limits):
+        with self._lock:
+            for name, limit in limits:
+                if self.in_flight.get(name, 0) >= limit:
+                    self.shed[name] = self.shed.get(name, 0) + 1
+                    return False
+            for name, limit in limits:
+                self.in_flight[name] = self.in_flight.get(name, 0) + 1
+            return True
+
+    def release(self, names):
+        with self._lock:
+            for name in names:
+                self.in_flight[name] -= 1
+
+    def stats(self):
+        with self._lock:
+            return {'in_flight': dict(self.in_flight), 'shed': dict(self.shed)}
+
+
+request_limiter = ConcurrencyLimiter()
+
+
+def admit_request():
+    # static files are never shed
+    if request.endpoint == 'static':
+        return
+
+    config = current_app.config
+    limits = [('global', config['MAX_IN_FLIGHT'])]
+    if request.endpoint in config['ENDPOINT_IN_FLIGHT']:
+        limits.append((request.endpoint, config['ENDPOINT_IN_FLIGHT'][request.endpoint]))
+
+    if not request_limiter.try_acquire(limits):
+        # rendered by the 503 error handler with a Retry-After header
+        abort(503)
+    g.admitted = [name for name, limit in limits]
+
+
+def release_request(exception=None):
+    names = g.pop('admitted', None)
+    if names:
+        request_limiter.release(names)
+
+
+# register the admission layer with the app
+def init_limiter(app):
+    app.before_request(admit_request)
+    app.teardown_request(release_request)
@@ -1,27 +1,40 @@
 # IMPORTS
-import copy
-from flask import Blueprint, render_template, request, flash
+from flask import Blueprint, render_template, request, flash, current_app
 from flask_login import login_required, current_user
-from app import db, requires_roles
-from models import Draw
+from app import requires_roles
+from database import db, read_session
+from models import (User, Draw, ArchivedDraw, RoundResult, Winner, DrawView, DRAW_VIEW_COLUMNS,
+                    ARCHIVED_DRAW_VIEW_COLUMNS, cipher_cache, current_draw_key, draw_row, parse_draw_line,
+                    parse_form_draw)
+from pagination import keyset_page, page_cursor
 
 # CONFIG
 lottery_blueprint = Blueprint('lottery', __name__, template_folder='templates')
 
 
-# decrypt original draws
+# decrypt draw rows selected with DRAW_VIEW_COLUMNS into read-only draw views
 def decrypt_draws(draws):
-    # creates a list of copied draw objects which are independent of database.
-    draws_copies = list(map(lambda x: copy.deepcopy(x), draws))
-    # empty list for decrypted copied draw objects
-    decrypted_draws = []
+    return [DrawView.decrypt(d) for d in draws]
 
-    # decrypt each copied draw object and add it to decrypted_draws array.
-    for d in draws_copies:
-        d.view_draw(current_user.draw_key)
-        decrypted_draws.append(d)
 
-    return decrypted_draws
+# the requested page of a query for the current user's draws, only the draws on the page are decrypted
+def draws_page(draws, id_column=Draw.id):
+    page = keyset_page(draws, id_column, after=page_cursor())
+    return page._replace(items=decrypt_draws(page.items))
+
+
+# column-only query for the current user's draws, on the read-only session
+def user_draws(played):
+    return read_session.query(*DRAW_VIEW_COLUMNS) \
+        .join(User, Draw.user_id == User.id) \
+        .filter(Draw.user_id == current_user.id, Draw.played == played)
+
+
+# column-only query for the current user's archived draws, on the read-only session
+def user_archived_draws():
+    return read_session.query(*ARCHIVED_DRAW_VIEW_COLUMNS) \
+        .join(User, ArchivedDraw.user_id == User.id) \
+        .filter(ArchivedDraw.user_id == current_user.id)
 
 
 # VIEWS
@@ -37,13 +50,14 @@ def lottery():
 @login_required
 @requires_roles('user')
 def add_draw():
-    submitted_draw = ''
-    for i in range(6):
-        submitted_draw += request.form.get('no' + str(i + 1)) + ' '
-    submitted_draw.strip()
+    submitted_draw, reason = parse_form_draw(request.form)
+    if reason:
+        flash(reason)
+        return lottery()
 
     # create a new draw with the form data.
-    new_draw = Draw(user_id=current_user.id, draw=submitted_draw, win=False, round=0, draw_key=current_user.draw_key)
+    new_draw = Draw(user_id=current_user.id, draw=submitted_draw, win=False, round=0,
+                    draw_key=current_draw_key(current_user.id))
 
     # add the new draw to the database
     db.session.add(new_draw)
@@ -54,34 +68,93 @@ def add_draw():
     return lottery()
 
 
+# (line number, line) of every non-blank line of a bulk submission. reading stops after limit + 1 lines, which is
+# enough to reject an oversized submission
+def submitted_lines(text, limit):
+    lines = []
+    for number, line in enumerate(text, start=1):
+        if line.strip():
+            lines.append((number, line.strip()))
+            if len(lines) > limit:
+                break
+    return lines
+
+
+# submit many draws at once, one per line of the form's text area or of an uploaded CSV file
+@lottery_blueprint.route('/add_draws', methods=['POST'])
+@login_required
+@requires_roles('user')
+def add_draws():
+    upload = request.files.get('draws_file')
+    if upload and upload.filename:
+        # the uploaded file is read one line at a time
+        text = (line.decode('utf-8', errors='replace') for line in upload.stream)
+    else:
+        text = request.form.get('draws', '').splitlines()
+    lines = submitted_lines(text, current_app.config['MAX_BULK_DRAWS'])
+
+    if not lines:
+        flash('No draws submitted.')
+        return lottery()
+    if len(lines) > current_app.config['MAX_BULK_DRAWS']:
+        flash('At most %d draws can be submitted at once.' % current_app.config['MAX_BULK_DRAWS'])
+        return lottery()
+
+    # every line is checked, accepted lines are encrypted with one cipher for the user's draw key
+    cipher = cipher_cache.get(current_draw_key(current_user.id))
+    rows = []
+    report = []
+    for number, line in lines:
+        draw, reason = parse_draw_line(line)
+        if draw:
+            rows.append(draw_row(current_user.id, draw, win=False, round=0, cipher=cipher))
+        report.append((number, line, reason))
+
+    # insert accepted draws with a single executemany in one transaction
+    if rows:
+        db.session.execute(Draw.__table__.insert(), rows)
+        db.session.commit()
+
+    flash('%d of %d draws submitted.' % (len(rows), len(lines)))
+    return render_template('lottery.html', bulk_report=report)
+
+
 # view all draws that have not been played
 @lottery_blueprint.route('/view_draws', methods=['POST'])
 @login_required
 @requires_roles('user')
 def view_draws():
-    # get all draws that have not been played [played=0] belonging to current user
-    playable_draws = Draw.query.filter_by(user_id=current_user.id, played=False).all()
+    # get a page of draws that have not been played [played=0] belonging to current user
+    page = draws_page(user_draws(played=False))
 
     # if playable draws exist
-    if len(playable_draws) != 0:
+    if page.total != 0:
         # re-render lottery page with decrypted playable draws
-        return render_template('lottery.html', playable_draws=decrypt_draws(playable_draws))
+        return render_template('lottery.html', playable_draws=page.items, playable_page=page)
     else:
         flash('No playable draws.')
         return lottery()
 
 
-# view lottery results
+# view lottery results, or the results of archived draws if the form's archived flag is set
 @lottery_blueprint.route('/check_draws', methods=['POST'])
 @login_required
 @requires_roles('user')
 def check_draws():
-    # get played draws belonging to current user
-    played_draws = Draw.query.filter_by(user_id=current_user.id, played=True).all()
+    if request.form.get('archived'):
+        page = draws_page(user_archived_draws(), ArchivedDraw.id)
+
+        if page.total != 0:
+            return render_template('lottery.html', results=page.items, results_page=page, archived=True)
+        flash("No archived draws.")
+        return lottery()
+
+    # get a page of played draws belonging to current user
+    page = draws_page(user_draws(played=True))
 
     # if played draws exist
-    if len(played_draws) != 0:
-        return render_template('lottery.html', results=decrypt_draws(played_draws), played=True)
+    if page.total != 0:
+        return render_template('lottery.html', results=page.items, results_page=page, played=True)
 
     # if no played draws exist [all draw entries have been played therefore wait for next lottery round]
     else:
@@ -89,6 +162,23 @@ def check_draws():
         return lottery()
 
 
+# rounds the current user has won, kept after their played draws are deleted
+@lottery_blueprint.route('/view_wins', methods=['POST'])
+@login_required
+@requires_roles('user')
+def view_wins():
+    wins = read_session.query(Winner.id, Winner.round, Winner.matches, RoundResult.winning_draw,
+                              RoundResult.finished_on) \
+        .join(RoundResult, Winner.round == RoundResult.round) \
+        .filter(Winner.user_id == current_user.id)
+    page = keyset_page(wins, Winner.id, after=page_cursor())
+
+    if page.total == 0:
+        flash("No winning draws yet.")
+        return lottery()
+    return render_template('lottery.html', wins=page.items, wins_page=page)
+
+
 # delete all played draws
 @lottery_blueprint.route('/play_again', methods=['POST'])
 @login_required
@@ -0,0 +1,146 @@
+# IMPORTS
+import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from flask import before_render_template, current_app, g, has_request_context, request, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# CONFIG
+# per-request totals, exported per endpoint as lottery_<name>_total
+REQUEST_COUNTERS = ['requests', 'request_seconds', 'sql_queries', 'sql_seconds', 'crypto_seconds', 'kdf_seconds',
+                    'render_seconds']
+
+slow_logger = logging.getLogger('lottery.slow')
+
+
+# totals per endpoint since the process started.
+# work done outside a request (lottery run jobs, worker pools) is counted under the endpoint 'background'
+class Metrics:
+    def __init__(self):
+        self.endpoints = defaultdict(lambda: defaultdict(float))
+        self._lock = threading.Lock()
+
+    def add(self, endpoint, values):
+        with self._lock:
+            totals = self.endpoints[endpoint]
+            for name, value in values.items():
+                totals[name] += value
+
+    def snapshot(self):
+        with self._lock:
+            return {endpoint: dict(totals) for endpoint, totals in self.endpoints.items()}
+
+
+metrics = Metrics()
+
+
+# add to the current request's totals, or straight to the background totals outside a request
+def record(name, value):
+    if has_request_context() and 'metrics' in g:
+        g.metrics[name] += value
+    else:
+        metrics.add('background', {name: value})
+
+
+# time a stage of work, e.g. with timed('crypto'): ...
+@contextmanager
+def timed(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage + '_seconds', time.perf_counter() - start)
+
+
+# SQL: every statement sent through any engine is counted and timed
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    record('sql_queries', 1)
+    record('sql_seconds', time.perf_counter() - conn.info['query_start'].pop())
+
+
+# TEMPLATES
+def before_render(sender, template, context, **extra):
+    g.render_start = time.perf_counter()
+
+
+def after_render(sender, template, context, **extra):
+    start = g.pop('render_start', None)
+    if start is not None:
+        record('render_seconds', time.perf_counter() - start)
+
+
+# REQUESTS
+def start_request():
+    g.metrics = defaultdict(float)
+    g.request_start = time.perf_counter()
+
+
+def finish_request(exception=None):
+    totals = g.pop('metrics', None)
+    if totals is None:
+        return
+
+    elapsed = time.perf_counter() - g.pop('request_start')
+    totals['requests'] = 1
+    totals['request_seconds'] = elapsed
+    endpoint = request.endpoint or 'unknown'
+    metrics.add(endpoint, totals)
+
+    slow_ms = current_app.config['SLOW_REQUEST_MS']
+    if slow_ms is not None and elapsed * 1000 >= slow_ms:
+        slow_logger.warning('Slow request %s %s [%s] %.1fms: %d queries %.1fms, crypto %.1fms, kdf %.1fms, '
+                            'render %.1fms', request.method, request.path, endpoint, elapsed * 1000,
+                            totals['sql_queries'], totals['sql_seconds'] * 1000, totals['crypto_seconds'] * 1000,
+                            totals['kdf_seconds'] * 1000, totals['render_seconds'] * 1000)
+
+
+# register the request hooks and template signals with the app
+def init_metrics(app):
+    app.before_request(start_request)
+    app.teardown_request(finish_request)
+    before_render_template.connect(before_render, app)
+    template_rendered.connect(after_render, app)
+
+    # slow requests are written to stderr, not to the security log
+    if not slow_logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(asctime)s : %(message)s', '%m/%d/%Y %I:%M:%S %p'))
+        slow_logger.addHandler(handler)
+        slow_logger.propagate = False
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# all metrics in the Prometheus text exposition format.
+# gauges maps a name to a stats dict, e.g. {'cipher_cache': {'hits': 3, ...}}, nested dicts become labels
+def render_prometheus(gauges):
+    lines = []
+    snapshot = metrics.snapshot()
+    for name in REQUEST_COUNTERS:
+        lines.append('# TYPE lottery_%s_total counter' % name)
+        for endpoint in sorted(snapshot):
+            lines.append('lottery_%s_total{endpoint="%s"} %r' % (name, escape_label(endpoint),
+                                                                 float(snapshot[endpoint].get(name, 0))))
+
+    for group in sorted(gauges):
+        for key, value in sorted(gauges[group].items()):
+            metric = 'lottery_%s_%s' % (group, key)
+            lines.append('# TYPE %s gauge' % metric)
+            if isinstance(value, dict):
+                for label, labelled in sorted(value.items()):
+                    lines.append('%s{name="%s"} %r' % (metric, escape_label(label), float(labelled)))
+            else:
+                lines.append('%s %r' % (metric, float(value)))
+
+    return '\n'.join(lines) + '\n'
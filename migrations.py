@@ -0,0 +1,211 @@
+# IMPORTS
+from sqlalchemy import bindparam, inspect, text
+from database import db
+from models import User, Draw, ArchivedDraw, LotteryRun, RoundResult, Winner, decrypt_batch, draw_index
+
+# CONFIG
+# number of rows read and written per transaction while backfilling
+BATCH_SIZE = 1000
+
+
+# the schema version of the database is kept in SQLite's user_version pragma
+def schema_version():
+    return db.session.execute(text('PRAGMA user_version')).scalar()
+
+
+def set_schema_version(version):
+    db.session.execute(text('PRAGMA user_version = %d' % version))
+    db.session.commit()
+
+
+def column_names(table):
+    return [column['name'] for column in inspect(db.engine).get_columns(table)]
+
+
+# recreate a table from its model, for changes SQLite cannot make with ALTER TABLE. the table is renamed to
+# <table>_old and its rows are copied back with the given INSERT ... SELECT
+def rebuild_table(model, copy):
+    table = model.__table__
+    connection = db.session.connection()
+    for index in inspect(connection).get_indexes(table.name):
+        db.session.execute(text('DROP INDEX %s' % index['name']))
+    db.session.execute(text('ALTER TABLE %s RENAME TO %s_old' % (table.name, table.name)))
+    table.create(connection)
+    db.session.execute(text(copy))
+    db.session.execute(text('DROP TABLE %s_old' % table.name))
+
+
+# MIGRATIONS
+# 1: keyed blind index of every draw's numbers
+def add_draw_index():
+    if 'draw_index' not in column_names('draws'):
+        db.session.execute(text('ALTER TABLE draws ADD COLUMN draw_index VARCHAR(64)'))
+    db.session.execute(text('CREATE INDEX IF NOT EXISTS ix_draws_draw_index ON draws (draw_index)'))
+    db.session.commit()
+
+    backfill_draw_index()
+
+
+# compute the blind index of draws that do not have one, one batch per transaction
+def backfill_draw_index(batch_size=BATCH_SIZE):
+    update = Draw.__table__.update() \
+        .where(Draw.__table__.c.id == bindparam('draw_id')) \
+        .values(draw_index=bindparam('index'))
+
+    last_id = 0
+    while True:
+        rows = db.session.query(Draw.id, Draw.draw, User.draw_key) \
+            .join(User, Draw.user_id == User.id) \
+            .filter(Draw.draw_index == None, Draw.id > last_id) \
+            .order_by(Draw.id) \
+            .limit(batch_size) \
+            .all()
+
+        if not rows:
+            return
+
+        # malformed draws have no index and are skipped, they stay NULL
+        decrypted = decrypt_batch([(row.draw_key, row.draw) for row in rows])
+        indexes = [{'draw_id': row.id, 'index': draw_index(numbers)} for row, numbers in zip(rows, decrypted)]
+        indexes = [row for row in indexes if row['index'] is not None]
+        if indexes:
+            db.session.execute(update, indexes)
+        db.session.commit()
+        last_id = rows[-1].id
+
+
+# 2: indexes for the draws table access paths
+def add_draws_indexes():
+    db.session.execute(text('CREATE INDEX IF NOT EXISTS ix_draws_user_id_played ON draws (user_id, played)'))
+    db.session.execute(text('CREATE INDEX IF NOT EXISTS ix_draws_win_played ON draws (win, played)'))
+    db.session.commit()
+
+
+# 3: per-round results and winners history.
+# rounds played before results were kept are counted from the played draws still in the table
+def add_round_history():
+    RoundResult.__table__.create(db.session.connection(), checkfirst=True)
+    Winner.__table__.create(db.session.connection(), checkfirst=True)
+
+    db.session.execute(text('INSERT INTO round_results (round, entries, winners) '
+                            'SELECT round, count(*), sum("match") FROM draws '
+                            'WHERE win = 0 AND played = 1 AND round NOT IN (SELECT round FROM round_results) '
+                            'GROUP BY round'))
+    db.session.execute(text('INSERT INTO winners (round, user_id, draw_id) '
+                            'SELECT round, user_id, id FROM draws '
+                            'WHERE win = 0 AND played = 1 AND "match" = 1 AND round NOT IN (SELECT round FROM winners)'))
+    db.session.commit()
+
+
+# 4: checkpoints of lottery runs
+def add_lottery_runs():
+    LotteryRun.__table__.create(db.session.connection(), checkfirst=True)
+    db.session.commit()
+
+
+# 5: prize tier of every winner
+def add_winner_matches():
+    if 'matches' not in column_names('winners'):
+        db.session.execute(text('ALTER TABLE winners ADD COLUMN matches INTEGER NOT NULL DEFAULT 6'))
+    db.session.commit()
+
+
+# 6: previous draw key of every user, kept by a key rotation
+def add_old_draw_key():
+    if 'old_draw_key' not in column_names('users'):
+        db.session.execute(text('ALTER TABLE users ADD COLUMN old_draw_key BLOB'))
+    db.session.commit()
+
+
+# 7: archive of played draws
+def add_archived_draws():
+    ArchivedDraw.__table__.create(db.session.connection(), checkfirst=True)
+    db.session.commit()
+
+
+# 8: ids of deleted and archived draws are not reused. archived draws get their own id and keep the draw's id
+def add_draw_id_sequence():
+    if 'draw_id' not in column_names('archived_draws'):
+        rebuild_table(ArchivedDraw,
+                      'INSERT INTO archived_draws (draw_id, user_id, draw, "match", round, draw_index, archived_on) '
+                      'SELECT id, user_id, draw, "match", round, draw_index, archived_on FROM archived_draws_old '
+                      'ORDER BY id')
+
+    schema = db.session.execute(text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'draws'")).scalar()
+    if 'AUTOINCREMENT' not in schema.upper():
+        rebuild_table(Draw,
+                      'INSERT INTO draws (id, user_id, draw, played, "match", win, round, draw_index) '
+                      'SELECT id, user_id, draw, played, "match", win, round, draw_index FROM draws_old')
+
+    # new draws are numbered after every id a draw has had, including archived draws and winners
+    db.session.execute(text("DELETE FROM sqlite_sequence WHERE name = 'draws'"))
+    db.session.execute(text("INSERT INTO sqlite_sequence (name, seq) SELECT 'draws', max("
+                            "coalesce((SELECT max(id) FROM draws), 0), "
+                            "coalesce((SELECT max(draw_id) FROM archived_draws), 0), "
+                            "coalesce((SELECT max(draw_id) FROM winners), 0))"))
+    db.session.commit()
+
+
+# 9: owner and heartbeat of lottery runs, claimed by one worker process at a time
+def add_lottery_run_owner():
+    columns = column_names('lottery_runs')
+    if 'owner' not in columns:
+        db.session.execute(text('ALTER TABLE lottery_runs ADD COLUMN owner VARCHAR(64)'))
+    if 'heartbeat_on' not in columns:
+        db.session.execute(text('ALTER TABLE lottery_runs ADD COLUMN heartbeat_on DATETIME'))
+    db.session.commit()
+
+
+# migrations in the order they are applied, the schema version is the number applied
+MIGRATIONS = [
+    add_draw_index,
+    add_draws_indexes,
+    add_round_history,
+    add_lottery_runs,
+    add_winner_matches,
+    add_old_draw_key,
+    add_archived_draws,
+    add_draw_id_sequence,
+    add_lottery_run_owner,
+]
+
+
+# bring an existing database up to the latest schema without losing data.
+# run inside an app context, e.g. from a python shell: from migrations import upgrade_db; upgrade_db()
+def upgrade_db():
+    version = schema_version()
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        migration()
+        set_schema_version(number)
+
+
+# mark a database created by init_db as up to date
+def stamp_db():
+    set_schema_version(len(MIGRATIONS))
+
+
+# QUERY PLANS
+# SQLite's plan for a SQLAlchemy statement, e.g. 'SEARCH draws USING INDEX ix_draws_win_played (win=? AND played=?)'
+def query_plan(statement):
+    compiled = statement.compile(db.engine)
+    params = tuple(compiled.params[name] for name in compiled.positiontup)
+    rows = db.session.connection().exec_driver_sql('EXPLAIN QUERY PLAN ' + str(compiled), params)
+    return '; '.join(row[-1] for row in rows)
+
+
+# check that the hot queries on draws are answered from their index instead of a full table scan
+def check_query_plans():
+    expected = [
+        (Draw.query.filter_by(user_id=1, played=False).statement, 'ix_draws_user_id_played'),
+        (Draw.query.filter_by(user_id=1, played=True).statement, 'ix_draws_user_id_played'),
+        (Draw.query.filter_by(win=True, played=False).statement, 'ix_draws_win_played'),
+        (Draw.__table__.delete().filter_by(user_id=1, played=True), 'ix_draws_user_id_played'),
+        (Winner.query.filter_by(user_id=1).statement, 'ix_winners_user_id_round'),
+        (Winner.query.filter_by(round=1).statement, 'ix_winners_round'),
+        (ArchivedDraw.query.filter_by(user_id=1).statement, 'ix_archived_draws_user_id'),
+    ]
+
+    for statement, index in expected:
+        plan = query_plan(statement)
+        if index not in plan:
+            raise AssertionError('%s does not use %s: %s' % (statement, index, plan))
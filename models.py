@@ -1,19 +1,153 @@
-import base64
+import hashlib
+import hmac
+import threading
+from collections import OrderedDict, namedtuple
 from datetime import datetime
-from Crypto.Protocol.KDF import scrypt
-from Crypto.Random import get_random_bytes
 from flask_login import UserMixin
-from cryptography.fernet import Fernet
-from werkzeug.security import generate_password_hash
-from app import db
+from cryptography.fernet import Fernet, InvalidToken, MultiFernet
+from flask import current_app
+from sqlalchemy import event, true
+from database import db
+from metrics import timed
+from kdf import derive_draw_key, hash_password
+
+
+# number of Fernet ciphers kept per process
+CIPHER_CACHE_SIZE = 1024
+
+
+# bounded LRU cache of Fernet ciphers keyed by draw key, saves decoding the key for every draw.
+# a tuple of keys (see draw_keys) gets a MultiFernet that encrypts with the first key and decrypts with any
+class CipherCache:
+    def __init__(self, maxsize=CIPHER_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._ciphers = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, draw_key):
+        with self._lock:
+            cipher = self._ciphers.get(draw_key)
+            if cipher is not None:
+                self._ciphers.move_to_end(draw_key)
+                self.hits += 1
+                return cipher
+            self.misses += 1
+
+        if isinstance(draw_key, tuple):
+            cipher = MultiFernet([Fernet(key) for key in draw_key])
+        else:
+            cipher = Fernet(draw_key)
+        with self._lock:
+            self._ciphers[draw_key] = cipher
+            # evict the least recently used cipher
+            if len(self._ciphers) > self.maxsize:
+                self._ciphers.popitem(last=False)
+        return cipher
+
+    # drop the ciphers of one draw key, or every cipher if no key is given
+    def invalidate(self, draw_key=None):
+        with self._lock:
+            if draw_key is None:
+                self._ciphers.clear()
+            else:
+                for key in [key for key in self._ciphers
+                            if key == draw_key or (isinstance(key, tuple) and draw_key in key)]:
+                    del self._ciphers[key]
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._ciphers), 'maxsize': self.maxsize}
+
+
+cipher_cache = CipherCache()
+
+
+# the keys a user's draws can be encrypted with: their draw key and, after a key rotation, the previous key
+def draw_keys(draw_key, old_draw_key=None):
+    return (draw_key, old_draw_key) if old_draw_key else (draw_key,)
 
 
 def encrypt(data, draw_key):
-    return Fernet(draw_key).encrypt(bytes(data, 'utf-8'))
+    with timed('crypto'):
+        return cipher_cache.get(draw_key).encrypt(bytes(data, 'utf-8'))
 
 
 def decrypt(data, draw_key):
-    return Fernet(draw_key).decrypt(data).decode("utf-8")
+    with timed('crypto'):
+        return cipher_cache.get(draw_key).decrypt(data).decode("utf-8")
+
+
+# decrypt a list of (draw_key, data) pairs, looking the cipher up again only when the key changes.
+# module level so it can be sent to a process pool
+def decrypt_batch(pairs):
+    decrypted = []
+    cipher_key = cipher = None
+    with timed('crypto'):
+        for draw_key, data in pairs:
+            if draw_key != cipher_key:
+                cipher_key, cipher = draw_key, cipher_cache.get(draw_key)
+            decrypted.append(cipher.decrypt(data).decode("utf-8"))
+    return decrypted
+
+
+# re-encrypt a list of (draw_keys, data) pairs with the first of their keys, the data can be encrypted with any
+# of them. data that none of the keys decrypt gives None. module level so it can be sent to a process pool
+def rotate_batch(pairs):
+    rotated = []
+    cipher_key = cipher = None
+    with timed('crypto'):
+        for keys, data in pairs:
+            if keys != cipher_key:
+                cipher_key, cipher = keys, cipher_cache.get(keys)
+            try:
+                rotated.append(cipher.rotate(data))
+            except InvalidToken:
+                rotated.append(None)
+    return rotated
+
+
+# parse one draw, e.g. '1 2 3 4 5 6' or '1,2,3,4,5,6'.
+# returns (draw, None) or (None, reason the draw was rejected)
+def parse_draw_line(line):
+    numbers = line.replace(',', ' ').split()
+    if len(numbers) != 6:
+        return None, 'A draw must have 6 numbers.'
+    if not all(n.isdigit() and 1 <= int(n) <= 60 for n in numbers):
+        return None, 'Numbers must be between 1 and 60.'
+    # same format as draws submitted one at a time
+    return ' '.join(str(int(n)) for n in numbers) + ' ', None
+
+
+# parse the draw entered in a form's no1 to no6 fields, one number per field.
+# returns (draw, None) or (None, reason the draw was rejected)
+def parse_form_draw(form):
+    numbers = [form.get('no' + str(i + 1), '').strip() for i in range(6)]
+    if not all(numbers):
+        return None, 'A draw must have 6 numbers.'
+    if not all(n.isdigit() for n in numbers):
+        return None, 'Numbers must be between 1 and 60.'
+    return parse_draw_line(' '.join(numbers))
+
+
+# normalise a draw to its numbers in ascending order, e.g. '6 5 4 3 2 1 ' -> '1 2 3 4 5 6'.
+# None if the draw is malformed
+def normalise_draw(draw):
+    draw, reason = parse_draw_line(draw)
+    if reason:
+        return None
+    return ' '.join(str(n) for n in sorted(int(n) for n in draw.split()))
+
+
+# keyed digest of a draw's numbers, lets draws be matched with an indexed lookup instead of decrypting them.
+# None if the draw is malformed, such a draw never matches a winning draw
+def draw_index(draw):
+    numbers = normalise_draw(draw)
+    if numbers is None:
+        return None
+    key = current_app.config['DRAW_INDEX_KEY'].encode('utf-8')
+    return hmac.new(key, numbers.encode('utf-8'), hashlib.sha256).hexdigest()
 
 
 class User(db.Model, UserMixin):
@@ -39,6 +173,8 @@ class User(db.Model, UserMixin):
 
     # crypto key for user's lottery draws
     draw_key = db.Column(db.BLOB)
+    # draw key before the last key rotation, draws still encrypted with it stay readable
+    old_draw_key = db.Column(db.BLOB, nullable=True)
 
     # Define the relationship to Draw
     draws = db.relationship('Draw')
@@ -49,10 +185,10 @@ class User(db.Model, UserMixin):
         self.lastname = lastname
         self.phone = phone
         # password hashing
-        self.password = generate_password_hash(password)
+        self.password = hash_password(password)
         self.pin_key = pin_key
         # generate draw_key from password
-        self.draw_key = base64.urlsafe_b64encode(scrypt(password, str(get_random_bytes(32)), 32, N=2 ** 14, r=8, p=1))
+        self.draw_key = derive_draw_key(password)
         self.role = role
 
         self.registered_on = datetime.now()
@@ -60,8 +196,29 @@ class User(db.Model, UserMixin):
         self.current_logged_in = None
 
 
+# a user's cached cipher is dropped when their draw key changes
+@event.listens_for(User.draw_key, 'set')
+def draw_key_changed(user, value, old_value, initiator):
+    if isinstance(old_value, bytes) and old_value != value:
+        cipher_cache.invalidate(old_value)
+
+
+# a user's current draw key, read from the database so new draws are never encrypted with the key of a cached
+# user from before a key rotation
+def current_draw_key(user_id):
+    return db.session.query(User.draw_key).filter(User.id == user_id).scalar()
+
+
 class Draw(db.Model):
     __tablename__ = 'draws'
+    __table_args__ = (
+        # a user's playable/played draws (view_draws, check_draws, play_again)
+        db.Index('ix_draws_user_id_played', 'user_id', 'played'),
+        # the current winning draw and the un-played user draws of a round (admin)
+        db.Index('ix_draws_win_played', 'win', 'played'),
+        # ids of deleted and archived draws are never given to new draws, winners and archived draws refer to them
+        {'sqlite_autoincrement': True},
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey(User.id), nullable=False)
@@ -70,11 +227,14 @@ class Draw(db.Model):
     match = db.Column(db.BOOLEAN, nullable=False, default=False)
     win = db.Column(db.BOOLEAN, nullable=False)
     round = db.Column(db.Integer, nullable=False, default=0)
+    # blind index of the draw's numbers, NULL for draws entered before it was introduced
+    draw_index = db.Column(db.String(64), nullable=True, index=True)
 
     def __init__(self, user_id, draw, win, round, draw_key):
         self.user_id = user_id
         # encrypt draw
         self.draw = encrypt(draw, draw_key)
+        self.draw_index = draw_index(draw)
         self.played = False
         self.match = False
         self.win = win
@@ -84,6 +244,114 @@ class Draw(db.Model):
         self.draw = decrypt(self.draw, draw_key)
 
 
+# progress of a lottery run, committed with every batch of draws so an interrupted run can be resumed
+class LotteryRun(db.Model):
+    __tablename__ = 'lottery_runs'
+
+    id = db.Column(db.Integer, primary_key=True)
+    round = db.Column(db.Integer, nullable=False, unique=True, index=True)
+    winning_draw_id = db.Column(db.Integer, nullable=False)
+    # highest user draw id in the round
+    last_id = db.Column(db.Integer, nullable=False)
+    # checkpoint: every un-played draw up to this id has been played
+    last_draw_id = db.Column(db.Integer, nullable=False, default=0)
+    entries = db.Column(db.Integer, nullable=False)
+    processed = db.Column(db.Integer, nullable=False, default=0)
+    winners = db.Column(db.Integer, nullable=False, default=0)
+    started_on = db.Column(db.DateTime, nullable=False)
+    # NULL until the run has finished
+    finished_on = db.Column(db.DateTime, nullable=True)
+    # the run playing the round and when it last committed a batch. another worker process only takes over a run
+    # whose owner has not committed for LOTTERY_RUN_TIMEOUT seconds
+    owner = db.Column(db.String(64), nullable=True)
+    heartbeat_on = db.Column(db.DateTime, nullable=True)
+
+
+# result of a played lottery round, written by the lottery run in the same transaction as its draw updates
+class RoundResult(db.Model):
+    __tablename__ = 'round_results'
+
+    id = db.Column(db.Integer, primary_key=True)
+    round = db.Column(db.Integer, nullable=False, unique=True, index=True)
+    # winning numbers, published once the round is played. NULL for rounds played before results were kept
+    winning_draw = db.Column(db.String(100), nullable=True)
+    # number of user draws played and of winning draws
+    entries = db.Column(db.Integer, nullable=False)
+    winners = db.Column(db.Integer, nullable=False)
+    # timings of the lottery run, NULL for rounds played before results were kept
+    started_on = db.Column(db.DateTime, nullable=True)
+    finished_on = db.Column(db.DateTime, nullable=True)
+    seconds = db.Column(db.Float, nullable=True)
+
+
+# a winning user draw of a played round and its prize tier, kept after the user deletes their played draws
+class Winner(db.Model):
+    __tablename__ = 'winners'
+    __table_args__ = (
+        # rounds won by a user (lottery history)
+        db.Index('ix_winners_user_id_round', 'user_id', 'round'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    round = db.Column(db.Integer, nullable=False, index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey(User.id), nullable=False)
+    draw_id = db.Column(db.Integer, nullable=False)
+    # numbers of the winning draw matched, winners found before prize tiers were introduced matched all 6
+    matches = db.Column(db.Integer, nullable=False, server_default='6')
+
+
+# a played user draw moved out of draws by the retention job, keeping its draw id, owner, result and round.
+# rows are only added, a key rotation re-encrypts them in place
+class ArchivedDraw(db.Model):
+    __tablename__ = 'archived_draws'
+    __table_args__ = (
+        # a user's archived draws (check_draws)
+        db.Index('ix_archived_draws_user_id', 'user_id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    # id the draw had in draws, e.g. the draw_id of a winner
+    draw_id = db.Column(db.Integer, nullable=False, index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey(User.id), nullable=False)
+    draw = db.Column(db.String(100), nullable=False)
+    match = db.Column(db.BOOLEAN, nullable=False)
+    round = db.Column(db.Integer, nullable=False)
+    draw_index = db.Column(db.String(64), nullable=True)
+    archived_on = db.Column(db.DateTime, nullable=False)
+
+
+# column values of a new draw for a bulk insert, encrypted with a cipher the caller looked up once
+def draw_row(user_id, draw, win, round, cipher):
+    with timed('crypto'):
+        encrypted = cipher.encrypt(bytes(draw, 'utf-8'))
+    return {'user_id': user_id,
+            'draw': encrypted,
+            'played': False,
+            'match': False,
+            'win': win,
+            'round': round,
+            'draw_index': draw_index(draw)}
+
+
+# columns of a draw needed to display it, with its owner's keys. queries on them join users
+DRAW_VIEW_COLUMNS = (Draw.id, Draw.draw, Draw.played, Draw.match, Draw.round, User.draw_key, User.old_draw_key)
+# the same columns of an archived draw, which has been played
+ARCHIVED_DRAW_VIEW_COLUMNS = (ArchivedDraw.id, ArchivedDraw.draw, true().label('played'), ArchivedDraw.match,
+                              ArchivedDraw.round, User.draw_key, User.old_draw_key)
+
+
+# read-only decrypted draw, built from a column-only query instead of a copy of a Draw instance
+class DrawView(namedtuple('DrawView', 'id draw played match round')):
+    __slots__ = ()
+
+    # decrypt a row selected with DRAW_VIEW_COLUMNS with the owner's keys read along with it, which are current
+    # even if the owner's cached user is from before a key rotation
+    @classmethod
+    def decrypt(cls, row):
+        return cls(row.id, decrypt(row.draw, draw_keys(row.draw_key, row.old_draw_key)), row.played, row.match,
+                   row.round)
+
+
 def init_db():
     db.drop_all()
     db.create_all()
@@ -97,3 +365,7 @@ def init_db():
 
     db.session.add(admin)
     db.session.commit()
+
+    # a new database already has the latest schema
+    from migrations import stamp_db
+    stamp_db()
@@ -0,0 +1,26 @@
+# IMPORTS
+from collections import namedtuple
+from flask import current_app, request
+
+# one page of rows, with the total number of rows and the id cursor of the next page (None on the last page)
+Page = namedtuple('Page', 'items total next_cursor')
+
+
+# id cursor of the requested page, sent back by the page's 'next' form or given in the query string
+def page_cursor():
+    return request.values.get('after', type=int)
+
+
+# keyset pagination: the page of rows ordered by id that comes after the cursor.
+# only the rows of the page are loaded, the total is counted in the database
+def keyset_page(query, id_column, after=None, size=None):
+    size = size or current_app.config['PAGE_SIZE']
+    total = query.order_by(None).count()
+
+    if after:
+        query = query.filter(id_column > after)
+    # one extra row tells whether there is a next page
+    rows = query.order_by(id_column).limit(size + 1).all()
+
+    next_cursor = rows[size - 1].id if len(rows) > size else None
+    return Page(rows[:size], total, next_cursor)
@@ -0,0 +1,97 @@
+# IMPORTS
+import logging
+import re
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+query_logger = logging.getLogger('lottery.queries')
+
+
+# raised in development/test mode when a view repeats a statement or goes over its query budget
+class QueryCountError(Exception):
+    pass
+
+
+# normalise a statement so the same query with different literals or IN list lengths is grouped together
+def normalise_statement(statement):
+    statement = re.sub(r"'(?:[^']|'')*'", '?', statement)
+    statement = re.sub(r'\b\d+\b', '?', statement)
+    statement = re.sub(r'\(\s*\?(?:\s*,\s*\?)*\s*\)', '(?)', statement)
+    return re.sub(r'\s+', ' ', statement).strip()
+
+
+# budgets opened with query_budget, checked against every statement on any thread
+budgets = []
+budgets_lock = threading.Lock()
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def count_statement(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and 'statements' in g:
+        g.statements[normalise_statement(statement)] += 1
+    with budgets_lock:
+        for budget in budgets:
+            budget.append(statement)
+
+
+def start_request():
+    if current_app.debug or current_app.testing:
+        g.statements = Counter()
+
+
+# after the view: report statements repeated more than QUERY_REPEAT_THRESHOLD times (N+1 queries) and
+# endpoints over their QUERY_BUDGETS entry
+def check_request(response):
+    statements = g.pop('statements', None)
+    if statements is None:
+        return response
+
+    config = current_app.config
+    problems = ['%d x %s' % (count, statement) for statement, count in statements.most_common()
+                if count > config['QUERY_REPEAT_THRESHOLD']]
+    budget = config['QUERY_BUDGETS'].get(request.endpoint)
+    total = sum(statements.values())
+    if budget is not None and total > budget:
+        problems.append('%d statements, budget is %d' % (total, budget))
+
+    if problems:
+        message = 'Query count check failed in view %s: %s' % (request.endpoint, '; '.join(problems))
+        if config['QUERY_CHECK_ACTION'] == 'raise':
+            raise QueryCountError(message)
+        query_logger.warning(message)
+    return response
+
+
+# register the development/test mode checks with the app
+def init_query_checks(app):
+    app.before_request(start_request)
+    app.after_request(check_request)
+
+    # warnings are written to stderr, not to the security log
+    if not query_logger.handlers:
+        query_logger.addHandler(logging.StreamHandler())
+        query_logger.propagate = False
+
+
+# assert that a block of code sends at most max_queries statements, e.g. in a test:
+#   with query_budget(3):
+#       client.post('/view_draws')
+@contextmanager
+def query_budget(max_queries):
+    statements = []
+    with budgets_lock:
+        budgets.append(statements)
+    try:
+        yield statements
+    finally:
+        with budgets_lock:
+            budgets[:] = [budget for budget in budgets if budget is not statements]
+
+    if len(statements) > max_queries:
+        counts = Counter(normalise_statement(statement) for statement in statements)
+        raise AssertionError('%d statements, budget is %d: %s' % (
+            len(statements), max_queries, '; '.join('%d x %s' % (n, s) for s, n in counts.most_common())))
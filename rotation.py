@@ -0,0 +1,133 @@
+# IMPORTS
+import time
+from cryptography.fernet import Fernet
+from flask import current_app
+from sqlalchemy import bindparam
+from database import db
+from models import User, Draw, ArchivedDraw, cipher_cache, draw_keys, rotate_batch
+from admin.engine import Decryptor
+from users.cache import user_cache
+
+
+# ids of users selected by email, None selects every user
+def user_ids_for(emails):
+    if not emails:
+        return None
+    return [user_id for user_id, in db.session.query(User.id).filter(User.email.in_(emails))]
+
+
+# ids of selected users whose last rotation has not finished: they still have a previous key because some of
+# their draws may be encrypted with it
+def pending_user_ids(user_ids=None):
+    query = db.session.query(User.id).filter(User.old_draw_key != None)
+    if user_ids is not None:
+        query = query.filter(User.id.in_(user_ids))
+    return [user_id for user_id, in query.order_by(User.id)]
+
+
+# give users a new draw key, chunk_size users per transaction. a user's current key is kept as their previous
+# key, so their draws stay readable until they are re-encrypted.
+# users whose last rotation has not finished are skipped, a new key would replace the previous key their draws
+# may still be encrypted with. returns the number of users rotated
+def rotate_keys(user_ids=None, chunk_size=None):
+    chunk_size = chunk_size or current_app.config['ROTATION_CHUNK_SIZE']
+    users = User.__table__
+    # the previous key is checked again in the update, in case another rotation started after the select
+    update = users.update() \
+        .where(users.c.id == bindparam('user_id'), users.c.old_draw_key == None) \
+        .values(old_draw_key=users.c.draw_key, draw_key=bindparam('new_key'))
+
+    rotated = 0
+    last_id = 0
+    while True:
+        query = db.session.query(User.id).filter(User.id > last_id, User.old_draw_key == None)
+        if user_ids is not None:
+            query = query.filter(User.id.in_(user_ids))
+        chunk = [user_id for user_id, in query.order_by(User.id).limit(chunk_size)]
+
+        if not chunk:
+            break
+
+        rotated += db.session.execute(update, [{'user_id': user_id, 'new_key': Fernet.generate_key()}
+                                               for user_id in chunk]).rowcount
+        db.session.commit()
+        last_id = chunk[-1]
+
+    # ciphers and users cached by this process are dropped. other processes read a user's keys together with
+    # their draws, so a user they have cached from before the rotation does not matter
+    cipher_cache.invalidate()
+    user_cache.invalidate()
+    return rotated
+
+
+# re-encrypt draws and archived draws with their owner's current draw key, streaming chunk_size draws at a time in
+# id order. every chunk is re-encrypted over a pool of workers and written back in one transaction.
+# a draw none of its owner's keys decrypt is left as it is and reported instead of stopping the run. once all of
+# a user's draws are re-encrypted their previous key is cleared, which finishes their rotation.
+# progress is called with (draws re-encrypted, seconds) after every chunk.
+# returns (number of draws re-encrypted, [(table, draw id) of every draw that could not be decrypted])
+def reencrypt_draws(user_ids=None, chunk_size=None, workers=None, progress=None):
+    config = current_app.config
+    chunk_size = chunk_size or config['ROTATION_CHUNK_SIZE']
+    progress = progress or (lambda rows, seconds: None)
+
+    # previous keys of the users whose rotation this run finishes, read before any draw
+    query = db.session.query(User.id, User.old_draw_key).filter(User.old_draw_key != None)
+    if user_ids is not None:
+        query = query.filter(User.id.in_(user_ids))
+    old_keys = dict(query.all())
+
+    reencrypted = 0
+    failed = []
+    failed_users = set()
+    start = time.perf_counter()
+    with Decryptor(workers=workers or config['DECRYPT_WORKERS'], executor=config['DECRYPT_EXECUTOR'],
+                   batch_size=config['DECRYPT_BATCH_SIZE']) as pool:
+        for model in (Draw, ArchivedDraw):
+            table = model.__table__
+            update = table.update() \
+                .where(table.c.id == bindparam('row_id')) \
+                .values(draw=bindparam('token'))
+
+            last_id = 0
+            while True:
+                query = db.session.query(model.id, model.user_id, model.draw, User.draw_key, User.old_draw_key) \
+                    .join(User, model.user_id == User.id) \
+                    .filter(model.id > last_id)
+                if user_ids is not None:
+                    query = query.filter(model.user_id.in_(user_ids))
+                chunk = query.order_by(model.id).limit(chunk_size).all()
+
+                if not chunk:
+                    break
+
+                tokens = pool.map(rotate_batch,
+                                  [(draw_keys(row.draw_key, row.old_draw_key), row.draw) for row in chunk])
+                rows = []
+                for row, token in zip(chunk, tokens):
+                    if token is None:
+                        failed.append((table.name, row.id))
+                        failed_users.add(row.user_id)
+                    else:
+                        rows.append({'row_id': row.id, 'token': token})
+                if rows:
+                    db.session.execute(update, rows)
+                db.session.commit()
+                reencrypted += len(rows)
+                last_id = chunk[-1].id
+                progress(reencrypted, time.perf_counter() - start)
+
+    # a user's previous key is only cleared if it is still the key read at the start
+    users = User.__table__
+    finish = users.update() \
+        .where(users.c.id == bindparam('user_id'), users.c.old_draw_key == bindparam('old_key')) \
+        .values(old_draw_key=None)
+    finished = [{'user_id': user_id, 'old_key': old_key} for user_id, old_key in old_keys.items()
+                if user_id not in failed_users]
+    if finished:
+        db.session.execute(finish, finished)
+        db.session.commit()
+        cipher_cache.invalidate()
+        user_cache.invalidate()
+
+    return reencrypted, failed
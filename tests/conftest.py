@@ -0,0 +1,100 @@
+# IMPORTS
+import os
+import sys
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+from cryptography.fernet import Fernet
+from app import create_app
+from admin import jobs
+from database import db, dispose_engines
+from models import User, Draw, init_db
+from querycount import query_budget as statement_budget
+from users.cache import user_cache
+
+# CONFIG
+# cheap password hashing and key derivation, threads instead of processes for decryption
+TEST_CONFIG = {'TESTING': True,
+               'PASSWORD_HASH_METHOD': 'pbkdf2:sha256:1000',
+               'KDF_SCRYPT_N': 2 ** 4,
+               'DECRYPT_EXECUTOR': 'thread',
+               'QUERY_CHECK_ACTION': 'raise'}
+
+
+# app with a fresh database file holding the admin, an app context is pushed for the test
+@pytest.fixture
+def app(tmp_path):
+    app = create_app(dict(TEST_CONFIG,
+                          SQLALCHEMY_DATABASE_URI='sqlite:///' + str(tmp_path / 'lottery.db'),
+                          LOG_FILE=str(tmp_path / 'lottery.log')))
+    with app.app_context():
+        init_db()
+        yield app
+        db.session.remove()
+    dispose_engines(app)
+    # users and lottery jobs of this test's database must not be loaded by the next test
+    user_cache.invalidate()
+    jobs.jobs.clear()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+# log the test client in as a user, by id
+@pytest.fixture
+def login(client):
+    def login(user_id):
+        with client.session_transaction() as session:
+            session['_user_id'] = str(user_id)
+            session['_fresh'] = True
+    return login
+
+
+# post a form over https, as the app's security headers redirect plain http
+@pytest.fixture
+def post(client):
+    def post(url, **data):
+        return client.post(url, data=data, base_url='https://localhost')
+    return post
+
+
+# add a user with a random draw key, returns their id
+@pytest.fixture
+def add_user(app):
+    def add_user(email, role='user'):
+        user = User(email=email, password='Test1!', pin_key='BFB5S34STBLZCOB22K6PPYDCMZMH46OJ', firstname='Test',
+                    lastname='User', phone='0191-123-4567', role=role)
+        user.draw_key = Fernet.generate_key()
+        db.session.add(user)
+        db.session.commit()
+        return user.id
+    return add_user
+
+
+# add a draw for a user, encrypted with their current key, returns its id
+@pytest.fixture
+def add_draw(app):
+    def add_draw(user_id, numbers, played=False, round=0, win=False):
+        draw = Draw(user_id=user_id, draw=numbers, win=win, round=round,
+                    draw_key=db.session.get(User, user_id).draw_key)
+        draw.played = played
+        db.session.add(draw)
+        db.session.commit()
+        return draw.id
+    return add_draw
+
+
+# assert that a block sends at most the endpoint's QUERY_BUDGETS statements, e.g.
+#   with assert_query_budget('lottery.view_draws'):
+#       post('/view_draws')
+@pytest.fixture
+def assert_query_budget(app):
+    @contextmanager
+    def assert_query_budget(endpoint):
+        with statement_budget(app.config['QUERY_BUDGETS'][endpoint]) as statements:
+            yield statements
+    return assert_query_budget
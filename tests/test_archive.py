@@ -0,0 +1,86 @@
+from datetime import datetime
+import pytest
+from sqlalchemy import text
+from archive import archive_draws
+from database import db
+from migrations import MIGRATIONS, schema_version, upgrade_db
+from models import Draw, ArchivedDraw, RoundResult, Winner
+from rotation import pending_user_ids, reencrypt_draws, rotate_keys
+
+
+@pytest.fixture
+def user(add_user):
+    return add_user('user@email.com')
+
+
+def play_round(round):
+    db.session.add(RoundResult(round=round, entries=0, winners=0))
+    db.session.commit()
+
+
+def test_old_rounds_are_archived(user, add_draw, login, post):
+    old = add_draw(user, '1 2 3 4 5 6 ', played=True, round=1)
+    recent = add_draw(user, '1 2 3 4 5 7 ', played=True, round=2)
+    playable = add_draw(user, '1 2 3 4 5 8 ')
+    play_round(1)
+    play_round(2)
+
+    assert archive_draws(keep_rounds=1) == 1
+
+    assert [d.id for d in Draw.query.order_by(Draw.id)] == [recent, playable]
+    assert [(a.draw_id, a.round) for a in ArchivedDraw.query] == [(old, 1)]
+    login(user)
+    response = post('/check_draws', archived='1')
+    assert b'1 2 3 4 5 6' in response.data and b'1 2 3 4 5 7' not in response.data
+
+
+def test_archived_draw_ids_are_not_reused(user, add_draw):
+    first = add_draw(user, '1 2 3 4 5 6 ', played=True, round=1)
+    db.session.add(Winner(round=1, user_id=user, draw_id=first, matches=6))
+    play_round(1)
+    assert archive_draws(keep_rounds=0) == 1
+
+    # the highest draw id was archived, a new draw must not be given it again
+    second = add_draw(user, '1 2 3 4 5 7 ', played=True, round=2)
+    play_round(2)
+    assert second > first
+    assert archive_draws(keep_rounds=0) == 1
+
+    assert [a.draw_id for a in ArchivedDraw.query.order_by(ArchivedDraw.id)] == [first, second]
+    winner = Winner.query.one()
+    assert ArchivedDraw.query.filter_by(draw_id=winner.draw_id).one().round == 1
+
+
+def test_upgrade_archive_keyed_by_draw_id(user, add_draw):
+    add_draw(user, '1 2 3 4 5 6 ', played=True, round=1)
+    # archive and draws as created by schema version 7: the archive keyed by draw id, draw ids reused
+    ArchivedDraw.__table__.drop(db.session.connection())
+    db.session.execute(text('CREATE TABLE archived_draws (id INTEGER NOT NULL PRIMARY KEY, user_id INTEGER NOT NULL, '
+                            'draw VARCHAR(100) NOT NULL, "match" BOOLEAN NOT NULL, round INTEGER NOT NULL, '
+                            'draw_index VARCHAR(64), archived_on DATETIME NOT NULL)'))
+    db.session.execute(text('INSERT INTO archived_draws (id, user_id, draw, "match", round, archived_on) '
+                            'VALUES (5, :user, :draw, 0, 1, :now)'),
+                       {'user': user, 'draw': Draw.query.first().draw, 'now': datetime.now()})
+    db.session.execute(text('PRAGMA user_version = 7'))
+    db.session.commit()
+
+    upgrade_db()
+
+    assert schema_version() == len(MIGRATIONS)
+    assert [a.draw_id for a in ArchivedDraw.query] == [5]
+    # new draws are numbered after the archived draw
+    assert add_draw(user, '1 2 3 4 5 7 ') == 6
+    assert len(Draw.query.all()) == 2
+
+
+def test_rotation_reencrypts_archived_draws(user, add_draw, login, post):
+    add_draw(user, '1 2 3 4 5 6 ', played=True, round=1)
+    play_round(1)
+    archive_draws(keep_rounds=0)
+
+    rotate_keys([user])
+    assert reencrypt_draws([user]) == (1, [])
+
+    assert pending_user_ids() == []
+    login(user)
+    assert b'1 2 3 4 5 6' in post('/check_draws', archived='1').data
@@ -0,0 +1,38 @@
+import io
+import pytest
+from models import Draw
+
+
+@pytest.fixture
+def user(add_user, login):
+    user_id = add_user('user@email.com')
+    login(user_id)
+    return user_id
+
+
+def upload(client, text):
+    return client.post('/add_draws', data={'draws_file': (io.BytesIO(text.encode('utf-8')), 'draws.csv')},
+                       content_type='multipart/form-data', base_url='https://localhost')
+
+
+def test_upload_is_checked_line_by_line(user, client):
+    response = upload(client, '1,2,3,4,5,6\n\n1 2 3\n7,8,9,10,11,12\n')
+
+    assert b'2 of 3 draws submitted.' in response.data
+    assert b'A draw must have 6 numbers.' in response.data
+    assert Draw.query.filter_by(user_id=user).count() == 2
+
+
+def test_upload_over_draw_limit_is_rejected(app, user, client):
+    app.config['MAX_BULK_DRAWS'] = 10
+    response = upload(client, '1,2,3,4,5,6\n' * 11)
+
+    assert b'At most 10 draws can be submitted at once.' in response.data
+    assert Draw.query.count() == 0
+
+
+def test_upload_over_content_length_is_not_read(app, user, client):
+    response = upload(client, '1,2,3,4,5,6\n' * (app.config['MAX_CONTENT_LENGTH'] // 12 + 1))
+
+    assert response.status_code == 413
+    assert Draw.query.count() == 0
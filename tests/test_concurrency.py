@@ -0,0 +1,13 @@
+import os
+import subprocess
+import sys
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks', 'concurrency.py')
+
+
+# readers make progress without errors while a lottery run holds the write transaction open
+def test_readers_progress_during_lottery_run():
+    check = subprocess.run([sys.executable, SCRIPT, '--users', '20', '--draws', '5', '--readers', '2',
+                            '--hold', '0.5'], capture_output=True, text=True, timeout=300)
+
+    assert check.returncode == 0, check.stdout + check.stderr
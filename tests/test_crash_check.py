@@ -0,0 +1,13 @@
+import os
+import subprocess
+import sys
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks', 'crash_check.py')
+
+
+# an interrupted lottery run resumes to the same results at every crash point of a batch's commit
+def test_interrupted_run_resumes_to_same_results():
+    check = subprocess.run([sys.executable, SCRIPT, '--users', '50', '--draws', '4', '--chunk', '20',
+                            '--crash-after', '2'], capture_output=True, text=True, timeout=300)
+
+    assert check.returncode == 0, check.stdout + check.stderr
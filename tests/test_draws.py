@@ -0,0 +1,57 @@
+import pytest
+from database import db
+from migrations import backfill_draw_index
+from models import User, Draw, draw_index, encrypt
+
+
+@pytest.fixture
+def user(add_user, login):
+    user_id = add_user('user@email.com')
+    login(user_id)
+    return user_id
+
+
+def form(*numbers):
+    return {'no%d' % (i + 1): n for i, n in enumerate(numbers)}
+
+
+@pytest.mark.parametrize('numbers, reason', [
+    (('x', '2', '3', '4', '5', '6'), b'Numbers must be between 1 and 60.'),
+    (('1', '2', '3', '4', '5', '61'), b'Numbers must be between 1 and 60.'),
+    (('1', '2', '3', '4', '5'), b'A draw must have 6 numbers.'),
+    (('1,2', '3', '4', '5', '6', ''), b'A draw must have 6 numbers.'),
+])
+def test_malformed_draw_is_rejected(user, post, numbers, reason):
+    response = post('/add_draw', **form(*numbers))
+
+    assert response.status_code == 200
+    assert reason in response.data
+    assert Draw.query.count() == 0
+
+
+def test_draw_is_submitted(user, post):
+    assert b'Draw 6 5 4 3 2 1  submitted.' in post('/add_draw', **form('6', '5', '4', '3', '2', '1')).data
+    assert Draw.query.one().draw_index == draw_index('1 2 3 4 5 6')
+
+
+def test_malformed_winning_draw_keeps_current_one(add_user, add_draw, login, post):
+    admin = add_user('admin2@email.com', role='admin')
+    current = add_draw(admin, '1 2 3 4 5 6 ', round=1, win=True)
+    login(admin)
+
+    response = post('/create_winning_draw', **form('1', '2', '3', '4', '5', 'x'))
+
+    assert b'Numbers must be between 1 and 60.' in response.data
+    assert [d.id for d in Draw.query.filter_by(win=True)] == [current]
+
+
+def test_backfill_skips_malformed_draws(user):
+    key = db.session.get(User, user).draw_key
+    for numbers in ('1 2 x 4 5 6 ', '1 2 3 4 5 6 '):
+        db.session.execute(Draw.__table__.insert(), {'user_id': user, 'draw': encrypt(numbers, key), 'played': False,
+                                                     'match': False, 'win': False, 'round': 0})
+    db.session.commit()
+
+    backfill_draw_index()
+
+    assert [d.draw_index for d in Draw.query.order_by(Draw.id)] == [None, draw_index('1 2 3 4 5 6')]
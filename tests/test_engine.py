@@ -0,0 +1,94 @@
+import os
+import sys
+import threading
+import pytest
+from cryptography.fernet import Fernet
+from admin.engine import Decryptor, RunInProgress, RunStats, claim_run, run_round
+from database import db
+from models import User, Draw, LotteryRun, RoundResult, Winner, encrypt
+
+
+# pid of the worker and whether the app module, and with it its after-fork handlers, was loaded there
+def worker_state(pairs):
+    return [(os.getpid(), 'app' in sys.modules) for pair in pairs]
+
+
+def test_process_decryptor_decrypts_in_order(app):
+    keys = [Fernet.generate_key() for _ in range(3)]
+    draws = ['1 2 3 4 5 %d ' % n for n in range(10, 40)]
+    pairs = [(keys[i % 3], encrypt(draw, keys[i % 3])) for i, draw in enumerate(draws)]
+
+    with Decryptor(workers=2, executor='process', batch_size=4) as pool:
+        assert pool.decrypt(pairs) == draws
+
+
+def test_process_workers_are_not_forked_from_the_app(app):
+    with Decryptor(workers=2, executor='process', batch_size=1) as pool:
+        states = pool.map(worker_state, [(b'key', b'data')] * 4)
+
+    assert os.getpid() not in {pid for pid, app_loaded in states}
+    assert not any(app_loaded for pid, app_loaded in states)
+
+
+@pytest.fixture
+def round_entries(add_user, add_draw):
+    admin = User.query.filter_by(role='admin').first()
+    user = add_user('user@email.com')
+    for n in range(10, 40):
+        add_draw(user, '1 2 3 4 5 %d ' % n)
+    winning_id = add_draw(admin.id, '1 2 3 4 5 10 ', round=1, win=True)
+    return winning_id, admin.draw_key
+
+
+def test_run_held_by_another_worker_is_not_played_twice(app, round_entries):
+    winning_id, key = round_entries
+    claim_run(RunStats(), db.session.get(Draw, winning_id), owner='other-worker')
+
+    with pytest.raises(RunInProgress):
+        run_round(db.session.get(Draw, winning_id), key)
+    assert Draw.query.filter_by(win=False, played=True).count() == 0
+
+    # the other worker stopped committing batches, its run is taken over
+    app.config['LOTTERY_RUN_TIMEOUT'] = 0
+    results, stats = run_round(db.session.get(Draw, winning_id), key)
+    assert len(results) == 30
+
+
+def test_run_taken_over_stops_before_next_batch(app, round_entries):
+    winning_id, key = round_entries
+    taken = []
+
+    def take_over(processed, total):
+        if processed and not taken:
+            LotteryRun.query.update({LotteryRun.owner: 'other-worker'})
+            db.session.commit()
+            taken.append(processed)
+
+    with pytest.raises(RunInProgress):
+        run_round(db.session.get(Draw, winning_id), key, chunk_size=10, progress=take_over)
+
+    assert Draw.query.filter_by(win=False, played=True).count() == taken[0] == 10
+    assert RoundResult.query.count() == 0
+
+
+def test_concurrent_runs_of_a_round_play_it_once(app, round_entries):
+    winning_id, key = round_entries
+    outcomes = []
+
+    def play():
+        with app.app_context():
+            try:
+                results, stats = run_round(db.session.get(Draw, winning_id), key, chunk_size=5)
+                outcomes.append(len(results))
+            except RunInProgress:
+                outcomes.append('in progress')
+
+    workers = [threading.Thread(target=play) for _ in range(2)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    assert sorted(outcomes, key=str) == [30, 'in progress']
+    assert Winner.query.count() == 30
+    assert RoundResult.query.count() == 1
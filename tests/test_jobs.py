@@ -0,0 +1,75 @@
+import time
+from datetime import datetime, timedelta
+import pytest
+from admin import jobs
+from admin.engine import RunStats, claim_run, run_round
+from database import db
+from models import User, Draw, LotteryRun
+
+
+@pytest.fixture
+def admin(app, login):
+    admin = User.query.filter_by(role='admin').first()
+    login(admin.id)
+    return admin
+
+
+@pytest.fixture
+def winning_draw(admin, add_user, add_draw):
+    user = add_user('user@email.com')
+    for n in range(10, 20):
+        add_draw(user, '1 2 3 4 5 %d ' % n)
+    return db.session.get(Draw, add_draw(admin.id, '1 2 3 4 5 10 ', round=1, win=True))
+
+
+def poll(client, round):
+    return client.get('/lottery_job/%d' % round, base_url='https://localhost')
+
+
+def test_job_is_polled_until_finished(winning_draw, client, post):
+    assert b'Lottery run for round 1 submitted.' in post('/run_lottery').data
+
+    deadline = time.monotonic() + 30
+    while poll(client, 1).get_json()['status'] in ('queued', 'running') and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    job = poll(client, 1).get_json()
+    assert (job['status'], job['processed'], job['total']) == ('finished', 10, 10)
+    # counts per prize tier, the winners themselves are paged by the round's winners view
+    assert job['winners'] == {'5': 9, '6': 1}
+    page = client.get(job['winners_url'], base_url='https://localhost').data
+    assert b'Showing 10 of 10 winners' in page
+
+
+def test_winners_are_reported_with_their_own_draw(winning_draw, admin):
+    results, stats = run_round(winning_draw, admin.draw_key)
+
+    draws = {d.id: d for d in Draw.query.filter_by(win=False)}
+    assert len(results) == 10
+    for round, user_id, email, draw_id, matches in results:
+        assert draws[draw_id].user_id == user_id and draws[draw_id].match
+    assert [matches for *_, matches in results] == [6] + [5] * 9
+
+
+def test_run_of_another_worker_is_polled_from_the_database(winning_draw, admin, client, post):
+    # played by another worker process, this process has no job for the round
+    run_round(winning_draw, admin.draw_key)
+    assert jobs.get_job(1).status == 'finished' and 1 not in jobs.jobs
+
+    job = poll(client, 1).get_json()
+    assert (job['status'], job['processed'], job['total']) == ('finished', 10, 10)
+    page = post('/view_lottery_job', round='1').data
+    assert b'9 winners matched 5 numbers' in page and b'1 winners matched 6 numbers' in page
+    assert poll(client, 2).status_code == 404
+    assert b'Lottery run not found.' in post('/view_lottery_job', round='2').data
+
+
+def test_unfinished_run_of_another_worker(app, winning_draw, client, post):
+    claim_run(RunStats(), winning_draw, owner='other-worker')
+    assert poll(client, 1).get_json()['status'] == 'running'
+
+    # the other worker stopped committing batches
+    LotteryRun.query.update({LotteryRun.heartbeat_on: datetime.now() - timedelta(hours=1)})
+    db.session.commit()
+    assert poll(client, 1).get_json()['status'] == 'interrupted'
+    assert b'was interrupted after 0 of 10 draws' in post('/view_lottery_job', round='1').data
@@ -0,0 +1,60 @@
+import logging
+import os
+import time
+from conftest import TEST_CONFIG
+from app import BatchWatchedFileHandler, create_app
+from database import dispose_engines
+
+
+def record(message):
+    return logging.LogRecord('', logging.WARNING, __file__, 0, message, None, None)
+
+
+def emit(handler, message):
+    handler.handle(record(message))
+    handler.flush_batch()
+
+
+def read(path):
+    with open(path) as f:
+        return f.read().splitlines()
+
+
+# two worker processes appending to the same log, which is rotated by an external tool between their writes
+def test_workers_share_an_externally_rotated_log(tmp_path):
+    log = str(tmp_path / 'lottery.log')
+    workers = [BatchWatchedFileHandler(log), BatchWatchedFileHandler(log)]
+
+    emit(workers[0], 'SECURITY - first')
+    emit(workers[1], 'SECURITY - second')
+    os.rename(log, log + '.1')
+    emit(workers[1], 'SECURITY - third')
+    emit(workers[0], 'SECURITY - fourth')
+    for handler in workers:
+        handler.close()
+
+    assert read(log + '.1') == ['SECURITY - first', 'SECURITY - second']
+    assert read(log) == ['SECURITY - third', 'SECURITY - fourth']
+
+
+def wait_for(path, line, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if os.path.exists(path) and any(entry.endswith(line) for entry in read(path)):
+            return True
+        time.sleep(0.01)
+    return False
+
+
+# logging is process-wide, an app created later with another log file moves the log there
+def test_later_app_with_another_log_file_replaces_the_log(app, tmp_path):
+    logging.getLogger('').warning('SECURITY - before')
+    assert wait_for(app.config['LOG_FILE'], 'SECURITY - before')
+
+    other = create_app(dict(TEST_CONFIG, SQLALCHEMY_DATABASE_URI=app.config['SQLALCHEMY_DATABASE_URI'],
+                            LOG_FILE=str(tmp_path / 'other.log')))
+    dispose_engines(other)
+    logging.getLogger('').warning('SECURITY - after')
+
+    assert wait_for(other.config['LOG_FILE'], 'SECURITY - after')
+    assert not any(entry.endswith('SECURITY - after') for entry in read(app.config['LOG_FILE']))
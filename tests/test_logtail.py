@@ -0,0 +1,77 @@
+import os
+from admin.logtail import follow, tail
+
+
+def write(path, lines, mode='a'):
+    with open(path, mode) as f:
+        f.writelines(line + '\n' for line in lines)
+
+
+def test_tail_continues_into_rotated_file(tmp_path):
+    log = str(tmp_path / 'lottery.log')
+    write(log + '.1', ['old%d' % i for i in range(5)], 'w')
+    write(log, ['new%d' % i for i in range(3)], 'w')
+
+    lines, offset, inode = tail(log, 5, block_size=8)
+
+    assert lines == ['old3', 'old4', 'new0', 'new1', 'new2']
+    assert offset == os.path.getsize(log)
+    assert inode == os.stat(log).st_ino
+
+
+def test_follow_returns_a_burst_over_several_polls(tmp_path):
+    log = str(tmp_path / 'lottery.log')
+    write(log, ['line%d' % i for i in range(10)], 'w')
+    _, offset, inode = tail(log, 10)
+    write(log, ['new%d' % i for i in range(250)])
+
+    polled = []
+    for _ in range(3):
+        lines, offset, inode = follow(log, 100, offset, inode)
+        assert len(lines) <= 100
+        polled += lines
+
+    assert polled == ['new%d' % i for i in range(250)]
+    assert follow(log, 100, offset, inode) == ([], offset, inode)
+
+
+def test_follow_leaves_partial_line(tmp_path):
+    log = str(tmp_path / 'lottery.log')
+    write(log, ['line0'], 'w')
+    with open(log, 'a') as f:
+        f.write('line1 still being writ')
+
+    lines, offset, inode = follow(log, 100, 0)
+
+    assert lines == ['line0']
+    assert offset == len('line0\n')
+
+
+def test_follow_finishes_rotated_file_then_reads_new_file(tmp_path):
+    log = str(tmp_path / 'lottery.log')
+    write(log, ['a%d' % i for i in range(3)], 'w')
+    _, offset, inode = tail(log, 10)
+
+    # more entries, then the log is rotated and the new file grows past the old offset
+    write(log, ['b0', 'b1'])
+    os.rename(log, log + '.1')
+    write(log, ['c%d' % i for i in range(10)], 'w')
+
+    lines, offset, inode = follow(log, 100, offset, inode)
+    assert lines == ['b0', 'b1']
+    lines, offset, inode = follow(log, 100, offset, inode)
+    assert lines == ['c%d' % i for i in range(10)]
+    assert inode == os.stat(log).st_ino
+
+
+def test_logs_tail_view(app, client, login, add_user):
+    login(add_user('admin2@email.com', role='admin'))
+    write(app.config['LOG_FILE'], ['entry%d' % i for i in range(3)], 'w')
+
+    first = client.get('/logs/tail', base_url='https://localhost').get_json()
+    write(app.config['LOG_FILE'], ['entry3'])
+    polled = client.get('/logs/tail', query_string={'since': first['offset'], 'inode': first['inode']},
+                        base_url='https://localhost').get_json()
+
+    assert first['lines'][-3:] == ['entry0', 'entry1', 'entry2']
+    assert polled['lines'] == ['entry3']
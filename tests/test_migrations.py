@@ -0,0 +1,59 @@
+from cryptography.fernet import Fernet
+from sqlalchemy import text
+from database import db
+from migrations import MIGRATIONS, check_query_plans, schema_version, upgrade_db
+from models import Draw, RoundResult, Winner, draw_index, encrypt
+
+# schema of a database created before the first migration
+BASELINE_SCHEMA = [
+    'CREATE TABLE users (id INTEGER NOT NULL PRIMARY KEY, email VARCHAR(100) NOT NULL UNIQUE, '
+    'password VARCHAR(100) NOT NULL, pin_key VARCHAR(100) NOT NULL, registered_on DATETIME, '
+    'last_logged_in DATETIME, current_logged_in DATETIME, firstname VARCHAR(100) NOT NULL, '
+    'lastname VARCHAR(100) NOT NULL, phone VARCHAR(100) NOT NULL, role VARCHAR(100) NOT NULL, draw_key BLOB)',
+    'CREATE TABLE draws (id INTEGER NOT NULL PRIMARY KEY, user_id INTEGER NOT NULL REFERENCES users (id), '
+    'draw VARCHAR(100) NOT NULL, played BOOLEAN NOT NULL, "match" BOOLEAN NOT NULL, win BOOLEAN NOT NULL, '
+    'round INTEGER NOT NULL)',
+]
+
+
+def test_new_database_is_up_to_date(app):
+    assert schema_version() == len(MIGRATIONS)
+    check_query_plans()
+
+
+def test_upgrade_baseline_database(app):
+    db.drop_all()
+    db.session.execute(text('PRAGMA user_version = 0'))
+    for statement in BASELINE_SCHEMA:
+        db.session.execute(text(statement))
+
+    key = Fernet.generate_key()
+    db.session.execute(text("INSERT INTO users (id, email, password, pin_key, firstname, lastname, phone, role, "
+                            "draw_key) VALUES (2, 'user@email.com', 'x', 'x', 'A', 'B', '1', 'user', :key)"),
+                       {'key': key})
+    draws = [('1 2 3 4 5 6 ', 1, 1, 1), ('1 2 3 4 5 7 ', 1, 0, 1), ('1 2 3 4 5 8 ', 0, 0, 0)]
+    for numbers, played, match, round in draws:
+        db.session.execute(text('INSERT INTO draws (user_id, draw, played, "match", win, round) '
+                                'VALUES (2, :draw, :played, :match, 0, :round)'),
+                           {'draw': encrypt(numbers, key), 'played': played, 'match': match, 'round': round})
+    db.session.commit()
+
+    upgrade_db()
+
+    assert schema_version() == len(MIGRATIONS)
+    check_query_plans()
+    assert [d.draw_index for d in Draw.query.order_by(Draw.id)] == [draw_index(d[0]) for d in draws]
+    result = RoundResult.query.filter_by(round=1).one()
+    assert (result.entries, result.winners) == (2, 1)
+    assert [(w.draw_id, w.matches) for w in Winner.query.filter_by(round=1)] == [(1, 6)]
+
+    # the id of a deleted draw is not given to a new one
+    Draw.query.filter_by(id=3).delete()
+    db.session.commit()
+    db.session.add(Draw(user_id=2, draw='1 2 3 4 5 9 ', win=False, round=0, draw_key=key))
+    db.session.commit()
+    assert [d.id for d in Draw.query.order_by(Draw.id)] == [1, 2, 4]
+
+    # upgrading an up to date database does nothing
+    upgrade_db()
+    assert schema_version() == len(MIGRATIONS)
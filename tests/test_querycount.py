@@ -0,0 +1,36 @@
+import pytest
+
+
+@pytest.fixture
+def user(add_user, add_draw, login):
+    user_id = add_user('user@email.com')
+    for n in range(10, 20):
+        add_draw(user_id, '1 2 3 4 5 %d ' % n)
+        add_draw(user_id, '1 2 3 4 5 %d ' % (n + 20), played=True, round=1)
+    login(user_id)
+    return user_id
+
+
+@pytest.mark.parametrize('url, endpoint', [('/view_draws', 'lottery.view_draws'),
+                                           ('/check_draws', 'lottery.check_draws'),
+                                           ('/view_wins', 'lottery.view_wins')])
+def test_lottery_views_within_query_budget(user, post, assert_query_budget, url, endpoint):
+    with assert_query_budget(endpoint) as statements:
+        response = post(url)
+
+    assert response.status_code == 200
+    assert statements
+
+
+def test_add_draws_within_query_budget(user, post, assert_query_budget):
+    with assert_query_budget('lottery.add_draws'):
+        response = post('/add_draws', draws='\n'.join('1 2 3 4 5 %d' % n for n in range(10, 60)))
+
+    assert b'50 of 50 draws submitted.' in response.data
+
+
+def test_query_budget_fails_over_budget(user, post, assert_query_budget):
+    with pytest.raises(AssertionError, match='budget is 2'):
+        with assert_query_budget('admin.view_winning_draw'):
+            post('/view_draws')
+            post('/view_draws')
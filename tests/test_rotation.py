@@ -0,0 +1,82 @@
+import pytest
+from cryptography.fernet import Fernet
+from database import db
+from models import User, Draw, decrypt, draw_keys, encrypt
+from rotation import pending_user_ids, reencrypt_draws, rotate_keys
+
+
+@pytest.fixture
+def user(add_user, add_draw):
+    user_id = add_user('user@email.com')
+    for n in range(10, 15):
+        add_draw(user_id, '1 2 3 4 5 %d ' % n)
+    return user_id
+
+
+# the user's draws, decrypted with their current key only
+def current_key_draws(user_id):
+    user = db.session.get(User, user_id)
+    db.session.refresh(user)
+    return [decrypt(d.draw, user.draw_key) for d in Draw.query.filter_by(user_id=user_id).order_by(Draw.id)]
+
+
+def readable_draws(user_id):
+    user = db.session.get(User, user_id)
+    db.session.refresh(user)
+    keys = draw_keys(user.draw_key, user.old_draw_key)
+    return [decrypt(d.draw, keys) for d in Draw.query.filter_by(user_id=user_id).order_by(Draw.id)]
+
+
+def test_rotation_reencrypts_draws(user):
+    expected = current_key_draws(user)
+
+    assert rotate_keys([user]) == 1
+    assert pending_user_ids() == [user]
+    rows, failed = reencrypt_draws([user])
+
+    assert (rows, failed) == (5, [])
+    assert pending_user_ids() == []
+    assert current_key_draws(user) == expected
+
+
+def test_second_rotation_before_reencryption_keeps_previous_key(user):
+    expected = current_key_draws(user)
+
+    assert rotate_keys([user]) == 1
+    old_key = db.session.get(User, user).old_draw_key
+    # e.g. an interrupted rotation retried: the user is skipped instead of losing the key their draws use
+    assert rotate_keys([user]) == 0
+    assert db.session.get(User, user).old_draw_key == old_key
+    assert readable_draws(user) == expected
+
+    assert reencrypt_draws([user]) == (5, [])
+    assert rotate_keys([user]) == 1
+    assert reencrypt_draws([user]) == (5, [])
+    assert current_key_draws(user) == expected
+
+
+def test_rotate_keys_command_finishes_pending_rotation(app, user):
+    expected = current_key_draws(user)
+    rotate_keys([user])
+
+    result = app.test_cli_runner().invoke(args=['rotate-keys', '--user', 'user@email.com'])
+
+    assert result.exit_code == 0, result.output
+    assert 'Finishing the previous rotation of 1 users.' in result.output
+    assert 'Draw keys of 1 users rotated.' in result.output
+    assert pending_user_ids() == []
+    assert current_key_draws(user) == expected
+
+
+def test_undecryptable_draws_are_reported(user):
+    bad = Draw.query.filter_by(user_id=user).order_by(Draw.id).first()
+    bad.draw = encrypt('1 2 3 4 5 6 ', Fernet.generate_key())
+    db.session.commit()
+
+    rotate_keys([user])
+    rows, failed = reencrypt_draws([user])
+
+    assert rows == 4
+    assert failed == [('draws', bad.id)]
+    # the user keeps their previous key, their rotation is not finished
+    assert pending_user_ids() == [user]
@@ -0,0 +1,33 @@
+import time
+from users import throttle
+from users.throttle import LoginThrottle
+
+CONFIG = {'LOGIN_IP_BURST': 2, 'LOGIN_IP_RATE': 0.001, 'LOGIN_ACCOUNT_BURST': 2, 'LOGIN_ACCOUNT_RATE': 0.001}
+
+
+def test_buckets_are_bounded_and_least_recently_used_are_evicted(monkeypatch):
+    monkeypatch.setattr(throttle, 'MAX_BUCKETS', 10)
+    limiter = LoginThrottle()
+
+    # an account tried from rotating IPs until it is throttled
+    assert limiter.allow('ip0', 'victim', CONFIG) and limiter.allow('ip1', 'victim', CONFIG)
+    for i in range(2, 50):
+        assert not limiter.allow('ip%d' % i, 'victim', CONFIG)
+        assert limiter.allow('ip%d' % i, 'other%d' % i, CONFIG)
+
+    assert len(limiter.buckets) == 10
+    assert ('account', 'victim') in limiter.buckets
+    assert ('ip', 'ip0') not in limiter.buckets
+
+
+def test_attempt_time_does_not_grow_with_buckets(monkeypatch):
+    monkeypatch.setattr(throttle, 'MAX_BUCKETS', 5000)
+    limiter = LoginThrottle()
+    for i in range(2500):
+        limiter.allow('ip%d' % i, 'user%d' % i, CONFIG)
+
+    start = time.perf_counter()
+    for i in range(2500, 4500):
+        limiter.allow('ip%d' % i, 'user%d' % i, CONFIG)
+    # a scan of every bucket on every attempt would take over a second here
+    assert time.perf_counter() - start < 0.5
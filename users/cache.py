@@ -0,0 +1,81 @@
+# IMPORTS
+import threading
+import time
+from collections import OrderedDict
+from flask import current_app
+from sqlalchemy import event
+from database import db
+from models import User
+
+# CONFIG
+# most users kept per process, the oldest entries are dropped first
+USER_CACHE_SIZE = 10000
+
+
+# per-process cache of detached users for Flask-Login's user loader, entries expire after a TTL
+class UserCache:
+    def __init__(self, maxsize=USER_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._users = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is not None and entry[0] > time.monotonic():
+                self.hits += 1
+                return entry[1]
+            # missing or expired
+            self._users.pop(user_id, None)
+            self.misses += 1
+            return None
+
+    def put(self, user, ttl):
+        with self._lock:
+            self._users.pop(user.id, None)
+            self._users[user.id] = (time.monotonic() + ttl, user)
+            if len(self._users) > self.maxsize:
+                self._users.popitem(last=False)
+
+    # drop one user, or every user if no id is given
+    def invalidate(self, user_id=None):
+        with self._lock:
+            if user_id is None:
+                self._users.clear()
+            else:
+                self._users.pop(user_id, None)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._users),
+                    'hit_rate': self.hits / lookups if lookups else 0.0}
+
+
+user_cache = UserCache()
+
+
+# Flask-Login user loader, only goes to the database when the user is not cached
+def load_user(id):
+    user_id = int(id)
+    user = user_cache.get(user_id)
+
+    if user is None:
+        user = User.query.get(user_id)
+        if user is None:
+            return None
+        # keep a detached copy so the cached user is never expired or changed by a request's session
+        db.session.expunge(user)
+        user_cache.put(user, current_app.config['USER_CACHE_TTL'])
+
+    # attach a copy of the cached user to this request's session without a query
+    return db.session.merge(user, load=False)
+
+
+# any change to a user written through the session (login times, role) drops the cached copy
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def user_changed(mapper, connection, user):
+    user_cache.invalidate(user.id)
@@ -0,0 +1,58 @@
+# IMPORTS
+import threading
+import time
+from collections import OrderedDict
+
+# CONFIG
+# buckets kept, the least recently used bucket is evicted to make room for a new one
+MAX_BUCKETS = 100000
+
+
+# per-IP and per-account token buckets for login attempts, kept in a bounded LRU in process memory.
+# an attempt takes one token from its IP's bucket and one from its account's bucket, buckets refill over time
+class LoginThrottle:
+    def __init__(self):
+        self.buckets = OrderedDict()
+        self.allowed = 0
+        # throttled attempts never reach the password hash check
+        self.throttled = 0
+        self._lock = threading.Lock()
+
+    # tokens left in a bucket after refilling it for the time since it was last used
+    def _tokens(self, key, burst, rate, now):
+        tokens, updated = self.buckets.get(key, (burst, now))
+        return min(burst, tokens + (now - updated) * rate)
+
+    def allow(self, ip, account, config):
+        now = time.monotonic()
+        limits = [(('ip', ip), config['LOGIN_IP_BURST'], config['LOGIN_IP_RATE']),
+                  (('account', account), config['LOGIN_ACCOUNT_BURST'], config['LOGIN_ACCOUNT_RATE'])]
+
+        with self._lock:
+            tokens = [self._tokens(key, burst, rate, now) for key, burst, rate in limits]
+
+            if min(tokens) < 1:
+                self.throttled += 1
+                # a throttled IP or account stays recently used, so it is not evicted while it is still being tried
+                for key, burst, rate in limits:
+                    if key in self.buckets:
+                        self.buckets.move_to_end(key)
+                return False
+
+            for (key, burst, rate), left in zip(limits, tokens):
+                self.buckets[key] = (left - 1, now)
+                self.buckets.move_to_end(key)
+            self.allowed += 1
+
+            # the least recently used buckets are the ones most likely to have refilled. evicting them keeps an
+            # attempt constant time however many IPs and accounts are tried
+            while len(self.buckets) > MAX_BUCKETS:
+                self.buckets.popitem(last=False)
+            return True
+
+    def stats(self):
+        with self._lock:
+            return {'allowed': self.allowed, 'throttled': self.throttled, 'buckets': len(self.buckets)}
+
+
+login_throttle = LoginThrottle()
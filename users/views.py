@@ -2,11 +2,15 @@
 import logging
 from datetime import datetime
 import pyotp
-from flask import Blueprint, render_template, flash, redirect, url_for, request, session
+from flask import Blueprint, render_template, flash, redirect, url_for, request, session, abort, \
+    current_app
 from flask_login import login_user, logout_user, current_user
-from werkzeug.security import check_password_hash
-from app import db, login_required, requires_roles
+from app import login_required, requires_roles
+from database import db
+from kdf import KdfBusy, check_password
 from models import User
+from users.cache import user_cache
+from users.throttle import login_throttle
 from users.forms import RegisterForm, LoginForm
 
 # CONFIG
@@ -32,13 +36,17 @@ def register():
             return render_template('register.html', form=form)
 
         # create a new user with the form data
-        new_user = User(email=form.email.data,
-                        firstname=form.firstname.data,
-                        lastname=form.lastname.data,
-                        phone=form.phone.data,
-                        password=form.password.data,
-                        pin_key=form.pin_key.data,
-                        role='user')
+        try:
+            new_user = User(email=form.email.data,
+                            firstname=form.firstname.data,
+                            lastname=form.lastname.data,
+                            phone=form.phone.data,
+                            password=form.password.data,
+                            pin_key=form.pin_key.data,
+                            role='user')
+        # too many registrations are already hashing
+        except KdfBusy:
+            abort(503)
 
         # add the new user to the database
         db.session.add(new_user)
@@ -69,13 +77,27 @@ def login():
     form = LoginForm()
 
     if form.validate_on_submit():
+        # turn away attempts over the IP or account rate before any database lookup or hashing
+        if not login_throttle.allow(request.remote_addr, form.email.data.lower(), current_app.config):
+            # log throttled login
+            logging.warning('SECURITY - Throttled login attempt [%s, %s]',
+                            form.email.data, request.remote_addr)
+            flash('Too many login attempts. Please try again later.')
+            return render_template('login.html', form=form), 429
+
         # increase login attempts by 1
         session['logins'] += 1
 
         user = User.query.filter_by(email=form.email.data).first()
 
         # username not matched or associated password not matched
-        if not user or not check_password_hash(user.password, form.password.data):
+        try:
+            password_matched = user and check_password(user.password, form.password.data)
+        # too many logins are already hashing
+        except KdfBusy:
+            abort(503)
+
+        if not password_matched:
             # if no match create appropriate error message based on login attempts
             if session['logins'] == 3:
                 flash('Number of incorrect logins exceeded')
@@ -147,5 +169,7 @@ def logout():
     logging.warning('SECURITY - Log out [%s, %s, %s, %s]',
                     current_user.id, current_user.firstname, current_user.lastname, request.remote_addr)
 
+    # drop the cached user
+    user_cache.invalidate(current_user.id)
     logout_user()
     return redirect(url_for('index'))
@@ -0,0 +1,42 @@
+# IMPORTS
+import os
+import sys
+from sqlalchemy import text
+from app import create_app
+from database import db
+
+# WSGI entry point, e.g. gunicorn --workers 4 --preload wsgi:app
+# the workers share the security log, which is rotated externally instead of by each worker
+app = create_app({'LOG_ROTATION': 'external'})
+
+
+# startup check: fork workers from this already created app (as gunicorn --preload does) and check that every
+# worker serves a page and reaches the database on its own connection. returns the pids of failed workers
+def check_workers(workers):
+    # open a connection in the parent first, the workers must not share it
+    with app.app_context():
+        db.session.execute(text('SELECT 1'))
+        db.session.remove()
+
+    pids = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                page = app.test_client().get('/', base_url='https://localhost')
+                with app.app_context():
+                    db.session.execute(text('SELECT count(*) FROM users')).scalar()
+                code = 0 if page.status_code == 200 else 1
+            finally:
+                os._exit(code)
+        pids.append(pid)
+
+    return [pid for pid in pids if os.waitpid(pid, 0)[1] != 0]
+
+
+if __name__ == '__main__':
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else os.cpu_count() or 1
+    failed = check_workers(workers)
+    print('%d of %d workers OK' % (workers - len(failed), workers))
+    sys.exit(1 if failed else 0)